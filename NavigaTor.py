@@ -13,14 +13,23 @@ lzo-compressed objects to files for further processing.
 
 import sys
 from cPickle import dumps, HIGHEST_PROTOCOL
-from threading import Thread, Lock, Event
-from re import match, findall
+from threading import Thread, Lock, Event, Semaphore
+from Queue import Queue, Empty
+from traceback import format_exc
+from re import match, findall, compile as re_compile
 import tarfile
 from StringIO import StringIO
-from time import mktime, sleep
+from time import mktime, sleep, time
+from datetime import datetime
+from socket import timeout as socket_timeout
 from stat import S_IMODE
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+from math import sqrt
+from random import random
+from array import array
 from argparse import ArgumentParser
+from getpass import getpass
+from os import devnull as null_device
 from os.path import join, dirname
 
 from pkg_resources import get_distribution
@@ -33,16 +42,126 @@ import pycurl
 
 sys.path.append(join(dirname(__file__), 'libs'))
 from SocksiPy.socks import socksocket, Socks5Error, PROXY_TYPE_SOCKS5
+from oracle import Oracle
+from jsonsocket import JSONServer
 
 
-Probe = namedtuple('Probe', 'path circs cbt streams perf bw')
+Probe = namedtuple('Probe',
+                   'path circs cbt streams perf bw rttstop bwsamples reason')
+# Fields added after bw default to None, so that older probes still unpickle.
+Probe.__new__.__defaults__ = (None, None, None)
 Probe_old = namedtuple('Probe', 'path circs cbt streams perf')
 Node = namedtuple('Node', 'desc ns')
+# Why adaptive RTT sampling stopped ('HALFWIDTH' or 'MAXIMUM'), after how
+# many RTT probes and with which confidence half-width in ms.
+RTTStop = namedtuple('RTTStop', 'reason samples halfwidth')
+# Local overhead measured while "workers" workers were running, in seconds:
+# SOCKS request until tor's reply ("socks") and until the stream's NEW event
+# ("events"), CLOSESTREAM round-trip ("closes") and GETINFO round-trip
+# ("pings"). Failed measurements are None.
+Calibration = namedtuple('Calibration',
+                         'date workers socks events closes pings')
+
+# Destination port of the first RTT probe stream of a circuit. Further
+# probes use the following ports.
+RTT_PORT = 80
+
+# Quantile of the standard normal distribution for the 95% confidence
+# interval used by adaptive RTT sampling.
+RTT_CONFIDENCE_Z = 1.96
+# Quantiles of Student's t-distribution for the 95% confidence interval by
+# degrees of freedom (number of RTTs - 1), starting with one. Beyond the
+# table, RTT_CONFIDENCE_Z applies.
+RTT_CONFIDENCE_T = (12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306,
+                    2.262, 2.228, 2.201, 2.179, 2.160, 2.145, 2.131, 2.120,
+                    2.110, 2.101, 2.093, 2.086, 2.080, 2.074, 2.069, 2.064,
+                    2.060, 2.056, 2.052, 2.048)
+
+# Bandwidth probes sample the number of bytes received every
+# BW_SAMPLE_INTERVAL seconds into BW_SAMPLE_SLOTS samples. Transfers longer
+# than both together (102.4 s) are sampled at halved resolutions.
+BW_SAMPLE_INTERVAL = 0.1
+BW_SAMPLE_SLOTS = 1024
+
+# Default deadlines in seconds for the stages in which a worker waits for
+# tor: circuit BUILT (or FAILED), CBT log message, CLOSED event of an RTT
+# probe stream and circuit CLOSED after closing it. A worker that overruns
+# a deadline is reclaimed and its probe is written with reason
+# 'TIMEOUT_<STAGE>', a worker whose stream tor fails to attach with reason
+# 'FAILED_ATTACH'.
+DEADLINES = {'BUILD': 180, 'CBT': 60, 'STREAM': 180, 'CLOSE': 60}
+
+# CBT message of tor-log_cbt.patch.
+CBT_PREFIX = 'circuit_send_next_onion_skin(): circuit '
+CBT_MESSAGE = re_compile('^circuit_send_next_onion_skin\(\): circuit '
+                         '([0-9]+) built in ([0-9]+)msec $')
+# Maximum number of CBTs kept for circuits nobody waits for.
+MAX_UNCLAIMED_CBTS = 1024
+
+# Destination of zero-hop calibration streams. Stream destinations of
+# circuits never reach this address and other streams are not from 127/8.
+CALIBRATION_DEST = '127.255.255.255'
+
+# Seconds after which the coverage scheduler refreshes its list of relays.
+COVERAGE_REFRESH = 3600
+
+# Parameters that can be changed at runtime through the control socket:
+# _Manager attribute, type and minimum value. Probe parameters apply to
+# workers started afterwards.
+PARAMETERS = {'threads': ('_num_threads', int, 1),
+              'prebuild': ('_prebuild', int, 0),
+              'buildthreads': ('_buildthreads', int, 1),
+              'rttprobes': ('_num_rttprobes', int, 0),
+              'ttfbprobes': ('_num_ttfbprobes', int, 0),
+              'bwprobes': ('_num_bwprobes', int, 0),
+              'probesleep': ('_probesleep', (int, float), 0),
+              'rttconcurrency': ('_rttconcurrency', int, 1),
+              'rttminprobes': ('_rttminprobes', int, 2)}
+
+
+def _stream_rtt(streams):
+    """
+    Calculate RTT in ms from the events of a successful RTT probe stream,
+    None otherwise.
+    """
+    sent = None
+    for stream in streams:
+        if stream.status == 'SENTCONNECT':
+            sent = stream.arrived_at
+        elif stream.status == 'FAILED' and sent is not None:
+            if stream.reason == 'TORPROTOCOL' or \
+               (stream.reason == 'END' and
+                    stream.remote_reason == 'CONNECTREFUSED'):
+                return 1000 * (stream.arrived_at - sent)
+            return None
+    return None
+
+
+def _halfwidth(rtts):
+    """
+    Half-width of the confidence interval of the mean of the given RTTs,
+    None for less than two RTTs. The variance is estimated from the RTTs,
+    so Student's t-distribution applies to small numbers of them.
+    """
+    num = len(rtts)
+    if num < 2:
+        return None
+    mean = sum(rtts) / num
+    variance = sum((rtt - mean) ** 2 for rtt in rtts) / (num - 1)
+    if num - 1 <= len(RTT_CONFIDENCE_T):
+        quantile = RTT_CONFIDENCE_T[num - 2]
+    else:
+        quantile = RTT_CONFIDENCE_Z
+    return quantile * sqrt(variance / num)
 
 
 def NavigaTor(controller, num_circuits=1, num_rttprobes=1, num_ttfbprobes=1,
               num_bwprobes=1, probesleep=0, num_threads=1, output='probe_',
-              network_protection=True):
+              network_protection=True, num_controllers=0, rttconcurrency=1,
+              rtthalfwidth=None, rttminprobes=5, prebuild=0,
+              buildthreads=None, deadlines=None, oracle_socket=None,
+              scheduler='findpath', control_socket=None, calibrate=None,
+              password=None):
     """
     Configure Tor client and start threads for probing the RTT and/or TTFB
     of Tor circuits.
@@ -52,10 +171,40 @@ def NavigaTor(controller, num_circuits=1, num_rttprobes=1, num_ttfbprobes=1,
         "num_ttfbprobes": number of TTFB probes to be taken for each circuit.
         "num_bwprobes": number of bw probes to be taken for each circuit.
         "probesleep": number of seconds to wait between probes.
-        "num_threads": number of threads to start that actually do the
-                       probing.
+        "num_threads": number of circuits that are probed at once.
         "output": prefix for output file(s).
         "network_protection": Anti-Hammering protection for the Tor network.
+        "num_controllers": number of additional control connections that
+                           take commands. With 0, commands share the
+                           connection used for event subscription.
+        "rttconcurrency": number of RTT probes in flight at once on each
+                          circuit.
+        "rtthalfwidth": stop RTT probing a circuit as soon as the 95%
+                        confidence half-width of its mean RTT in ms is
+                        reached. num_rttprobes is the maximum then.
+                        None takes num_rttprobes RTT probes always.
+        "rttminprobes": minimum number of successful RTT probes before
+                        adaptive RTT probing may stop.
+        "prebuild": number of circuits built ahead for queued paths while
+                    num_threads circuits are being probed.
+        "buildthreads": number of circuits that are built at once.
+                        None for num_threads + prebuild.
+        "deadlines": deadlines in seconds overriding DEADLINES by stage.
+        "oracle_socket": path of a Unix socket on which the fastest paths
+                         predicted from the measurements so far are served.
+                         Keeps serving after all circuits have been probed
+                         until interrupted.
+        "scheduler": 'findpath' uses tor's bandwidth-weighted path
+                     selection, 'coverage' builds explicit paths of the
+                     least measured relays.
+        "control_socket": path of a Unix socket on which parameters can be
+                          changed, scheduling can be paused and resumed,
+                          and measurements can be drained at runtime.
+        "calibrate": interval in seconds between calibrations of the local
+                     SOCKS and control port overhead. None for no
+                     calibration.
+        "password": password the additional control connections
+                    authenticate with, if tor requires one.
     """
 
     # RouterStatusEntryV3 support in Stem
@@ -70,7 +219,7 @@ def NavigaTor(controller, num_circuits=1, num_rttprobes=1, num_ttfbprobes=1,
     assert isinstance(controller, Controller), \
         'Controller has wrong type: %s.' % type(controller)
     for i in num_circuits, num_rttprobes, num_ttfbprobes, num_bwprobes,\
-            num_threads:
+            num_threads, num_controllers, rttconcurrency:
         assert isinstance(i, int), '%s has wrong type: %s.' % (i, type(i))
     # Maximum number of circuits that can be probed is limited by
     # the unique destination IP calculation. Currently there is no need to
@@ -78,6 +227,27 @@ def NavigaTor(controller, num_circuits=1, num_rttprobes=1, num_ttfbprobes=1,
     max_circuits = 255 + 255 * 256 + 255 * pow(256, 2) - 1
     assert num_circuits in range(1, max_circuits), \
         'num_circuits is out of range: %d.' % (num_circuits)
+    assert rttconcurrency >= 1, \
+        'rttconcurrency is out of range: %d.' % rttconcurrency
+    assert rtthalfwidth is None or rtthalfwidth > 0, \
+        'rtthalfwidth is out of range: %s.' % rtthalfwidth
+    assert rttminprobes >= 2, \
+        'rttminprobes is out of range: %d.' % rttminprobes
+    assert prebuild >= 0, 'prebuild is out of range: %d.' % prebuild
+    if buildthreads is None:
+        buildthreads = num_threads + prebuild
+    assert buildthreads >= 1, \
+        'buildthreads is out of range: %d.' % buildthreads
+    assert calibrate is None or calibrate > 0, \
+        'calibrate is out of range: %s.' % calibrate
+    assert scheduler in ('findpath', 'coverage'), \
+        'Unknown scheduler: %s.' % scheduler
+    stage_deadlines = DEADLINES.copy()
+    stage_deadlines.update(deadlines or {})
+    for stage, deadline in stage_deadlines.iteritems():
+        assert stage in DEADLINES, 'Unknown stage: %s.' % stage
+        assert deadline > 0, \
+            'Deadline of %s is out of range: %s.' % (stage, deadline)
 
     assert controller.get_version() > Version('0.2.3'), \
         ('Your tor version (%s) is too old. ' % controller.get_version() +
@@ -86,6 +256,9 @@ def NavigaTor(controller, num_circuits=1, num_rttprobes=1, num_ttfbprobes=1,
         ('Your tor version (%s) is too new. ' % controller.get_version() +
          'Tor version 0.2.3.x is required.')
 
+    pool = None
+    server = None
+    control = None
     try:
         # Configure tor client
         controller.set_conf("__DisablePredictedCircuits", "1")
@@ -102,18 +275,39 @@ def NavigaTor(controller, num_circuits=1, num_rttprobes=1, num_ttfbprobes=1,
             if not circ.build_flags or 'IS_INTERNAL' not in circ.build_flags:
                 controller.close_circuit(circ.id)
 
-        manager = _Manager(controller, num_circuits, num_rttprobes,
+        oracle = None
+        if oracle_socket:
+            oracle = Oracle()
+            server = JSONServer(oracle_socket, oracle.query)
+
+        pool = _ControllerPool(controller, num_controllers, password)
+        manager = _Manager(pool, num_circuits, num_rttprobes,
                            num_ttfbprobes, num_bwprobes, probesleep,
-                           num_threads, output, network_protection)
+                           num_threads, output, network_protection,
+                           rttconcurrency, rtthalfwidth, rttminprobes,
+                           prebuild, buildthreads, stage_deadlines, oracle,
+                           scheduler, calibrate)
+        if control_socket:
+            control = JSONServer(control_socket, manager.control)
         while True:
             manager.join(1)
             if not manager.is_alive():
                 break
 
+        # Keep answering queries until interrupted.
+        while server:
+            sleep(1)
+
     except KeyboardInterrupt:
         pass
 
     finally:
+        if control:
+            control.close()
+        if server:
+            server.close()
+        if pool:
+            pool.close()
         controller.reset_conf("__DisablePredictedCircuits")
         controller.reset_conf("__LeaveStreamsUnattached")
         controller.reset_conf("MaxCircuitDirtiness")
@@ -121,17 +315,214 @@ def NavigaTor(controller, num_circuits=1, num_rttprobes=1, num_ttfbprobes=1,
         controller.close()
 
 
+class _PooledConnection(object):
+    """ Control connection with its load and latency counters. """
+    def __init__(self, controller):
+        self.controller = controller
+        self.pending = 0
+        self.commands = 0
+        self.latency = 0.0
+
+
+class _ControllerPool(object):
+    """
+    Pool of authenticated control connections. The given controller is
+    dedicated to event subscription, commands are routed to the least
+    loaded of the additional connections.
+        "controller": authenticated Tor Controller from stem.control.
+        "num_connections": number of additional command connections.
+        "password": password the additional connections authenticate with,
+                    None if tor requires none or cookie authentication.
+    """
+    def __init__(self, controller, num_connections, password=None):
+        self._events = controller
+        self._lock = Lock()
+        self._conns = []
+        if num_connections < 1:
+            self._conns.append(_PooledConnection(controller))
+        ctrl_socket = controller.get_socket()
+        for _ in range(num_connections):
+            conn = Controller.from_port(address=ctrl_socket.get_address(),
+                                        port=ctrl_socket.get_port())
+            conn.authenticate(password=password)
+            self._conns.append(_PooledConnection(conn))
+
+    def __len__(self):
+        """ Number of command connections. """
+        return len(self._conns)
+
+    def add_event_listener(self, listener, *events):
+        """ Subscribe listener on the event connection. """
+        self._events.add_event_listener(listener, *events)
+
+    def remove_event_listener(self, listener):
+        """ Unsubscribe listener from the event connection. """
+        self._events.remove_event_listener(listener)
+
+    def __getattr__(self, name):
+        """
+        Route any other controller method to the command connection with the
+        fewest pending commands.
+        """
+        method = getattr(self._events, name)
+        if not callable(method):
+            return method
+
+        def command(*args, **kwargs):
+            """ Run command on least loaded connection and account it. """
+            with self._lock:
+                conn = min(self._conns, key=lambda c: c.pending)
+                conn.pending += 1
+            start = time()
+            try:
+                return getattr(conn.controller, name)(*args, **kwargs)
+            finally:
+                with self._lock:
+                    conn.pending -= 1
+                    conn.commands += 1
+                    conn.latency += time() - start
+        return command
+
+    def stats(self):
+        """
+        Queue depth and average command latency in ms of each command
+        connection.
+        """
+        with self._lock:
+            return ', '.join('%d/%.1fms' % (c.pending,
+                                            1000 * c.latency /
+                                            max(c.commands, 1))
+                             for c in self._conns)
+
+    def close(self):
+        """ Close the additional command connections. """
+        for conn in self._conns:
+            if conn.controller is not self._events:
+                conn.controller.close()
+
+
+class _CBTExtractor(object):
+    """
+    Single INFO log listener shared by all workers. It extracts CBTs from the
+    messages added by tor-log_cbt.patch and hands each one to the callback
+    registered for its circuit. A cheap prefix check rejects other messages
+    before the regular expression runs. CBTs of circuits nobody waits for
+    are kept for a while in case the callback is registered late.
+        "controller": authenticated Tor controller.
+    """
+    def __init__(self, controller):
+        self._lock = Lock()
+        self._waiting = dict()
+        self._unclaimed = OrderedDict()
+        controller.add_event_listener(self._check, EventType.INFO)
+
+    def _check(self, event):
+        """ Event listener for CBT messages from tor. """
+        if not event.message.startswith(CBT_PREFIX):
+            return
+        cbt_m = CBT_MESSAGE.match(event.message)
+        if not cbt_m:
+            return
+        cid, cbt = cbt_m.group(1), int(cbt_m.group(2))
+        with self._lock:
+            callback = self._waiting.pop(cid, None)
+            if not callback:
+                self._unclaimed[cid] = cbt
+                if len(self._unclaimed) > MAX_UNCLAIMED_CBTS:
+                    self._unclaimed.popitem(last=False)
+                return
+        callback(cbt)
+
+    def expect(self, cid, callback):
+        """ Call callback with the CBT of circuit cid once it is known. """
+        with self._lock:
+            cbt = self._unclaimed.pop(cid, None)
+            if cbt is None:
+                self._waiting[cid] = callback
+                return
+        callback(cbt)
+
+    def cancel(self, cid):
+        """ Stop waiting for the CBT of circuit cid. """
+        with self._lock:
+            self._waiting.pop(cid, None)
+
+
+class _StreamAttacher(object):
+    """
+    Attach streams to circuits asynchronously so that event handlers never
+    wait for a command round-trip. Requests are sent by "num_senders"
+    threads and each reply is handed to the callback of its request.
+        "controller": authenticated Tor controller.
+        "num_senders": number of requests in flight at once.
+    """
+    def __init__(self, controller, num_senders):
+        self._controller = controller
+        self._requests = Queue()
+        for _ in range(num_senders):
+            sender = Thread(target=self._send)
+            sender.daemon = True
+            sender.start()
+
+    def submit(self, stream_id, circ_id, callback):
+        """
+        Queue attaching stream to circuit. "callback" is called with
+        stream_id, circ_id and the error tor replied with or None.
+        """
+        self._requests.put((stream_id, circ_id, callback))
+
+    def _send(self):
+        """ Send queued requests and pass replies on to their callbacks. """
+        while True:
+            stream_id, circ_id, callback = self._requests.get()
+            error = None
+            try:
+                self._controller.attach_stream(stream_id, circ_id)
+            except (OperationFailed, InvalidRequest), err:
+                error = err
+            try:
+                callback(stream_id, circ_id, error)
+            except Exception:
+                sys.stderr.write(format_exc())
+
+
+def _resize(semaphore, old, new):
+    """
+    Change the number of slots of a semaphore from old to new. Slots in use
+    are taken away as soon as they are released.
+    """
+    for _ in range(old, new):
+        semaphore.release()
+    if new < old:
+        def take():
+            """ Take away slots once they are free. """
+            for _ in range(new, old):
+                semaphore.acquire()
+        taker = Thread(target=take)
+        taker.daemon = True
+        taker.start()
+
+
 class _Manager(Thread):
     """
     Start worker threads and provide methods to them for accessing shared
-    resources exclusively.
+    resources exclusively. Scheduling state and output have separate locks,
+    and finished workers are handed over through a queue, so that writing
+    probes never blocks scheduling and vice versa.
     """
     def __init__(self, controller, num_circuits, num_rttprobes,
                  num_ttfbprobes, num_bwprobes, probesleep, num_threads,
-                 output, network_protection):
+                 output, network_protection, rttconcurrency, rtthalfwidth,
+                 rttminprobes, prebuild, buildthreads, deadlines, oracle,
+                 scheduler, calibrate):
         self._controller = controller
         self._num_circuits = num_circuits
-        self._lock = Lock()
+        # Paths, relays being processed and the circuit count are only
+        # touched by the manager thread. _sched_lock guards the set of
+        # workers and counters shared with the watchdog, _output_lock the
+        # tar file.
+        self._sched_lock = Lock()
+        self._output_lock = Lock()
         self._output = output
         self._fileno = 0
         self._tar = self._create_tar_file()
@@ -140,19 +531,45 @@ class _Manager(Thread):
         self._circ_closed = Event()
         self._nodes_processing = set()
         self._paths_waiting = []
-        self.circ_launched = Lock()
+        self.attacher = _StreamAttacher(controller, len(controller))
+        self.cbts = _CBTExtractor(controller)
         self._threads = set()
-        self._threads_finished = []
+        self._finished = Queue()
         self._num_threads = num_threads
         self._num_rttprobes = num_rttprobes
         self._num_ttfbprobes = num_ttfbprobes
         self._num_bwprobes = num_bwprobes
         self._probesleep = probesleep
+        self._rttconcurrency = rttconcurrency
+        self._rtthalfwidth = rtthalfwidth
+        self._rttminprobes = rttminprobes
+        self._prebuild = prebuild
+        self._deadlines = deadlines
+        self._oracle = oracle
+        self._scheduler = scheduler
+        # Relays and number of paths chosen with each relay for the coverage
+        # scheduler.
+        self._relays = []
+        self._relays_updated = 0
+        self._coverage = dict()
+        self._reclaimed = 0
+        self._paused = False
+        self._draining = False
+        # Workers hold a build slot while their circuit is built and a probe
+        # slot while it is probed.
+        self._buildthreads = buildthreads
+        self.build_slots = Semaphore(buildthreads)
+        self.probe_slots = Semaphore(num_threads)
         self._network_protection = network_protection
         self.perf_lock = Lock()
         self.bw_lock = Lock()
-        self._worker_finished = Event()
-        self._worker_finished.set()
+        self._calibrations = 0
+        self._calibrator = None
+        if calibrate:
+            self._calibrator = _Calibrator(controller, self, calibrate)
+        watchdog = Thread(target=self._watchdog)
+        watchdog.daemon = True
+        watchdog.start()
         Thread.__init__(self)
         self.start()
 
@@ -166,72 +583,162 @@ class _Manager(Thread):
         """ Start worker thread. """
         thread = _Worker(self._controller, self, path, dest,
                          self._num_rttprobes, self._num_ttfbprobes,
-                         self._num_bwprobes, self._probesleep)
-        self._threads.add(thread)
+                         self._num_bwprobes, self._probesleep,
+                         self._rttconcurrency, self._rtthalfwidth,
+                         self._rttminprobes, self._deadlines)
+        with self._sched_lock:
+            self._threads.add(thread)
 
     def run(self):
         while True:
-            with self._lock:
-                for _ in range(self._num_threads - len(self._threads)):
-                    # Prefer any usable waiting path.
-                    data = self._get_waiting_path()
-                    if data:
-                        self.start_worker(data.path, data.dest)
-                    # Respect queue size.
-                    elif len(self._paths_waiting) >= 2 * self._num_threads:
-                        break
-                    # Find a new path and check if it can be used.
-                    elif self._num_circuits > 0:
-                        self._num_circuits -= 1
-                        path = self._get_new_path()
-                        if self._is_unused(path):
-                            if self._network_protection:
-                                for node in path:
-                                    fp = node.ns.fingerprint
-                                    assert node.ns.fingerprint not in \
-                                        self._nodes_processing, \
-                                        '%s being processed.' % fp
-                                    self._nodes_processing.add(fp)
-                            self.start_worker(path, self._get_dest())
-                        else:
-                            probedata = namedtuple('probedata', 'path dest')
-                            data = probedata(path=path, dest=self._get_dest())
-                            self._paths_waiting.append(data)
-                self._worker_finished.clear()
+            if self._draining:
+                self._num_circuits = 0
+                self._paths_waiting = []
+            for _ in range(self._num_threads + self._prebuild -
+                           len(self._threads)):
+                if self._paused:
+                    break
+                # Prefer any usable waiting path.
+                data = self._get_waiting_path()
+                if data:
+                    self.start_worker(data.path, data.dest)
+                # Respect queue size.
+                elif len(self._paths_waiting) >= 2 * self._num_threads:
+                    break
+                # Find a new path and check if it can be used.
+                elif self._num_circuits > 0:
+                    self._num_circuits -= 1
+                    path = self._get_new_path()
+                    if self._is_unused(path):
+                        if self._network_protection:
+                            for node in path:
+                                fp = node.ns.fingerprint
+                                assert node.ns.fingerprint not in \
+                                    self._nodes_processing, \
+                                    '%s being processed.' % fp
+                                self._nodes_processing.add(fp)
+                        self.start_worker(path, self._get_dest())
+                    else:
+                        probedata = namedtuple('probedata', 'path dest')
+                        data = probedata(path=path, dest=self._get_dest())
+                        self._paths_waiting.append(data)
 
             sys.stderr.write('Threads: %d, ' % len(self._threads) +
                              'Circuits: %d, ' % self._num_circuits +
-                             'Queue: %d\n' % len(self._paths_waiting))
+                             'Queue: %d, ' % len(self._paths_waiting) +
+                             'Reclaimed: %d, ' % self._reclaimed +
+                             'Paused: %s, ' % self._paused +
+                             'Control: %s\n' % self._controller.stats())
             # Stop Manager, if no new workers have been spawned and queue is
             # empty.
-            if len(self._threads) == 0:
+            if len(self._threads) == 0 and not self._paused:
                 break
 
-            # Wait for a worker to signal that it finished
-            self._worker_finished.wait()
-            # Wait for that worker to really have finished and
-            # prevent possible race condition.
-            self._threads_finished[0].join()
-
-            # Clean up thread queue.
-            tmp = self._threads.copy()
-            for _ in range(len(tmp)):
-                thread = tmp.pop()
-                if not thread.isAlive():
-                    # Remove nodes from processing list.
-                    if self._network_protection:
-                        for node in thread.path:
-                            fp = node.ns.fingerprint
-                            assert fp in self._nodes_processing, \
-                                'Node %s not in list.' % fp
-                            self._nodes_processing.remove(fp)
+            # Wait for workers to signal that they finished.
+            finished = [self._finished.get()]
+            while True:
+                try:
+                    finished.append(self._finished.get_nowait())
+                except Empty:
+                    break
+            for thread in finished:
+                # Woken up by the control socket.
+                if thread is None:
+                    continue
+                # Wait for that worker to really have finished.
+                thread.join()
+                # Remove nodes from processing list.
+                if self._network_protection:
+                    for node in thread.path:
+                        fp = node.ns.fingerprint
+                        assert fp in self._nodes_processing, \
+                            'Node %s not in list.' % fp
+                        self._nodes_processing.remove(fp)
+                with self._sched_lock:
                     self._threads.remove(thread)
-                    self._threads_finished.remove(thread)
-                    del thread
-            del tmp
+        if self._calibrator:
+            self._calibrator.stop()
         # close open tar file
         self._tar.close()
 
+    def control(self, request):
+        """
+        Handle a request from the control socket. "command" is one of:
+            "status": return scheduling state and parameters.
+            "set": change any of the parameters in PARAMETERS.
+            "pause": stop launching new workers.
+            "resume": launch new workers again.
+            "drain": stop launching new workers, finish the running ones,
+                     and close the output file.
+        Raise ValueError for invalid requests, which change nothing.
+        """
+        command = request.get('command')
+        if command not in ('status', 'set', 'pause', 'resume', 'drain'):
+            raise ValueError('Unknown command: %s.' % command)
+        parameters = dict((name, value) for name, value
+                          in request.iteritems() if name != 'command')
+        # Validate all parameters before changing any of them.
+        for name, value in parameters.iteritems():
+            if command != 'set':
+                raise ValueError('Unexpected parameter: %s.' % name)
+            if name not in PARAMETERS:
+                raise ValueError('Unknown parameter: %s.' % name)
+            if isinstance(value, bool) or \
+                    not isinstance(value, PARAMETERS[name][1]):
+                raise ValueError('%s has wrong type: %s.'
+                                 % (name, type(value)))
+            if value < PARAMETERS[name][2]:
+                raise ValueError('%s is out of range: %s.' % (name, value))
+        with self._sched_lock:
+            if command == 'set':
+                for name, value in parameters.iteritems():
+                    attribute = PARAMETERS[name][0]
+                    if name == 'threads':
+                        _resize(self.probe_slots, self._num_threads, value)
+                    elif name == 'buildthreads':
+                        _resize(self.build_slots, self._buildthreads, value)
+                    setattr(self, attribute, value)
+                max_dirtiness = (self._num_rttprobes +
+                                 self._num_ttfbprobes) * 10
+                if int(self._controller.get_conf("MaxCircuitDirtiness")) < \
+                        max_dirtiness:
+                    self._controller.set_conf("MaxCircuitDirtiness",
+                                              str(max_dirtiness))
+            elif command == 'pause':
+                self._paused = True
+            elif command == 'resume':
+                self._paused = False
+            elif command == 'drain':
+                self._paused = False
+                self._draining = True
+            status = dict((name, getattr(self, PARAMETERS[name][0]))
+                          for name in PARAMETERS)
+            status.update(workers=len(self._threads),
+                          circuits=self._num_circuits,
+                          queue=len(self._paths_waiting),
+                          paused=self._paused, draining=self._draining)
+        # Wake up the manager thread.
+        self._finished.put(None)
+        return status
+
+    def _watchdog(self):
+        """
+        Reclaim workers that overran the deadline of a stage, so that their
+        relays and slots are released.
+        """
+        while True:
+            sleep(1)
+            now = time()
+            with self._sched_lock:
+                workers = list(self._threads)
+            for worker in workers:
+                stage = worker.expired(now)
+                if stage and worker.reclaim('TIMEOUT_%s' % stage):
+                    sys.stderr.write('Reclaimed worker of circuit %s in ' %
+                                     worker.cid + 'stage %s.\n' % stage)
+                    with self._sched_lock:
+                        self._reclaimed += 1
+
     def _descriptor_check(self, event):
         """
         Event listener for checking that tor knows about all server
@@ -277,11 +784,8 @@ class _Manager(Thread):
                 self._paths_waiting.remove(data)
                 return data
 
-    def _get_new_path(self):
-        """
-        Choose a new path with detailed information on the nodes.
-        """
-        # Wait until tor knows all descriptors.
+    def _wait_for_descriptors(self):
+        """ Wait until tor knows all descriptors. """
         if not self._controller.get_info('status/enough-dir-info') == '1':
             sys.stderr.write("Waiting for server descriptors..\n")
             self._controller.add_event_listener(self._descriptor_check,
@@ -291,6 +795,15 @@ class _Manager(Thread):
             self._descriptors_known.clear()
             self._controller.remove_event_listener(self._descriptor_check)
 
+    def _get_new_path(self):
+        """
+        Choose a new path with detailed information on the nodes.
+        """
+        if self._scheduler == 'coverage':
+            return self._get_coverage_path()
+
+        self._wait_for_descriptors()
+
         # Change guard nodes for every path.
         msg = self._controller.msg('DUMPGUARDS')
         assert msg.is_ok(), 'DUMPGUARDS command failed with error "%s". '\
@@ -338,6 +851,51 @@ class _Manager(Thread):
         self._controller.remove_event_listener(self._circuit_check)
         return path
 
+    def _get_coverage_path(self):
+        """
+        Build a path of the least measured relays that are currently not
+        being probed. As in testdata._checkpath, relays must be running and
+        valid, the entry must be a guard and the exit must allow exiting.
+        Relays of a path must be in different /16 networks.
+        """
+        if time() - self._relays_updated > COVERAGE_REFRESH:
+            self._wait_for_descriptors()
+            descs = dict((desc.fingerprint, desc) for desc in
+                         self._controller.get_server_descriptors())
+            self._relays = [Node(ns=ns, desc=descs[ns.fingerprint])
+                            for ns in self._controller.get_network_statuses()
+                            if ns.fingerprint in descs and
+                            'Running' in ns.flags and 'Valid' in ns.flags]
+            self._relays_updated = time()
+
+        def least_measured(eligible):
+            """
+            Choose one of the least measured eligible relays, preferably
+            one that is not being probed.
+            """
+            networks = set(node.ns.address.rsplit('.', 2)[0]
+                           for node in chosen)
+            candidates = [node for node in self._relays if eligible(node) and
+                          node.ns.address.rsplit('.', 2)[0] not in networks]
+            assert candidates, 'No relay left to build a path.'
+            unused = [node for node in candidates if
+                      node.ns.fingerprint not in self._nodes_processing]
+            return min(unused or candidates,
+                       key=lambda node: (self._coverage.get(
+                           node.ns.fingerprint, 0), random()))
+
+        # Choose the most restricted positions first.
+        chosen = []
+        chosen.append(least_measured(
+            lambda node: node.desc.exit_policy.is_exiting_allowed()))
+        chosen.append(least_measured(lambda node: 'Guard' in node.ns.flags))
+        chosen.append(least_measured(lambda node: True))
+        path = [chosen[1], chosen[2], chosen[0]]
+        for node in path:
+            fprint = node.ns.fingerprint
+            self._coverage[fprint] = self._coverage.get(fprint, 0) + 1
+        return path
+
     def _is_unused(self, path):
         """
         A path is only usable at that time if all nodes within that
@@ -353,26 +911,242 @@ class _Manager(Thread):
         Serialize probe data, compress it and write it exclusively
         to output file.
         """
+        # Reclaimed probes may lack a circuit.
+        if probe.circs:
+            mtime = mktime(probe.circs[0].created.timetuple())
+        else:
+            mtime = time()
+        self._add('Probe_%s.lzo' % dest, probe, mtime)
+        if self._oracle:
+            self._learn(probe)
+        self._finished.put(worker)
+
+    def discard(self, worker):
+        """ Release the relays of a worker that failed to write its probe. """
+        self._finished.put(worker)
+
+    def write_calibration(self, calibration):
+        """
+        Serialize calibration data, compress it and write it exclusively
+        to output file.
+        """
+        self._calibrations += 1
+        self._add('Calibration_%06d.lzo' % self._calibrations, calibration,
+                  mktime(calibration.date.timetuple()))
+
+    def probe_concurrency(self):
+        """ Number of circuits probed at once. """
+        return self._num_threads
+
+    def deadline(self, stage):
+        """ Deadline in seconds of the given stage. """
+        return self._deadlines[stage]
+
+    def workers(self):
+        """ Number of running workers. """
+        with self._sched_lock:
+            return len(self._threads)
+
+    def _add(self, name, obj, mtime):
+        """ Add serialized and compressed object to output file. """
         data = StringIO()
-        data.write(compress(dumps(probe, HIGHEST_PROTOCOL)))
+        data.write(compress(dumps(obj, HIGHEST_PROTOCOL)))
         data.seek(0)
         info = tarfile.TarInfo()
-        info.name = 'Probe_%s.lzo' % dest
+        info.name = name
         info.uid = 0
         info.gid = 0
         info.size = len(data.buf)
         info.mode = S_IMODE(0o0444)
-        info.mtime = mktime(probe.circs[0].created.timetuple())
-        with self._lock:
+        info.mtime = mtime
+        full_tar = None
+        with self._output_lock:
             # Maximum file size is about 1 GB
             if self._bytes_written >= 1 * 1000 * 1000 * 1000:
-                self._tar.close()
+                full_tar = self._tar
                 self._tar = self._create_tar_file()
                 self._bytes_written = 0
             self._tar.addfile(tarinfo=info, fileobj=data)
             self._bytes_written += info.size
-            self._threads_finished.append(worker)
-            self._worker_finished.set()
+        # Finish the full file without blocking other writers.
+        if full_tar:
+            full_tar.close()
+
+    def _learn(self, probe):
+        """ Add the measurements of a probed circuit to the oracle. """
+        if len(probe.path) != 3 or not probe.cbt:
+            return
+        streams = dict()
+        for stream in probe.streams:
+            streams.setdefault(stream.id, []).append(stream)
+        rtts = [rtt for rtt in map(_stream_rtt, streams.values())
+                if rtt is not None]
+        ttfbs = [1000 * (perf[1] - perf[0]) for perf in probe.perf
+                 if len(perf) == 3]
+        values = dict(cbt=iter(probe.cbt).next(),
+                      rtt=sum(rtts) / len(rtts) if rtts else None,
+                      ttfb=sum(ttfbs) / len(ttfbs) if ttfbs else None)
+        relays = [(node.ns.fingerprint, 'Guard' in node.ns.flags,
+                   node.desc.exit_policy) for node in probe.path]
+        self._oracle.update(relays, values)
+
+
+class _Calibrator(Thread):
+    """
+    Thread that periodically measures local overhead while circuits are
+    being probed. Each round opens as many zero-hop SOCKS streams and sends
+    as many GETINFO commands at once as circuits are probed at once. The
+    streams are never attached: each is closed from a thread of its own as
+    soon as its NEW event arrives, so that SOCKS timings do not include
+    closing other streams.
+        "controller": an authenticated Tor controller.
+        "manager": for accessing shared resources.
+        "interval": seconds between calibration rounds.
+    """
+    def __init__(self, controller, manager, interval):
+        self._controller = controller
+        self._manager = manager
+        self._interval = interval
+        self._stopped = Event()
+        self._new_streams = Queue()
+        Thread.__init__(self)
+        self.daemon = True
+        self.start()
+
+    def stop(self):
+        """ Stop after the current round. """
+        self._stopped.set()
+        self.join()
+
+    def _stream_new(self, event):
+        """ Event handler for detecting calibration streams. """
+        if event.target_address == CALIBRATION_DEST and \
+           event.status == 'NEW' and event.purpose == 'USER':
+            self._new_streams.put(event)
+
+    def run(self):
+        socks_ip, socks_port = self._controller.get_socks_listeners()[0]
+        self._controller.add_event_listener(self._stream_new,
+                                            EventType.STREAM)
+        while not self._stopped.wait(self._interval):
+            num = self._manager.probe_concurrency()
+            workers = self._manager.workers()
+            deadline = self._manager.deadline('STREAM')
+            # Indexes of this round's streams by their SOCKS source port.
+            ports = dict()
+            started = [None] * num
+            socks = [None] * num
+            events = [None] * num
+            closes = [None] * num
+            pings = [None] * num
+
+            def _socks(i):
+                """ Measure SOCKS request until tor's reply. """
+                socket = socksocket()
+                socket.setproxy(PROXY_TYPE_SOCKS5, socks_ip, socks_port)
+                socket.settimeout(deadline)
+                # Bind first to know the source port of the stream.
+                socket.bind(('', 0))
+                ports[socket.getsockname()[1]] = i
+                started[i] = time()
+                try:
+                    socket.connect((CALIBRATION_DEST, RTT_PORT + i))
+                except Socks5Error:
+                    socks[i] = time() - started[i]
+                except socket_timeout:
+                    pass
+                socket.close()
+
+            def _ping(i):
+                """ Measure control port round-trip. """
+                start = time()
+                self._controller.msg('GETINFO traffic/read')
+                pings[i] = time() - start
+
+            def _close(event, i):
+                """ Close stream, measuring it if it is of this round. """
+                start = time()
+                try:
+                    self._controller.close_stream(event.id)
+                except (InvalidArguments, InvalidRequest, OperationFailed):
+                    return
+                if i is not None:
+                    closes[i] = time() - start
+
+            threads = [Thread(target=_socks, args=(i,)) for i in range(num)]
+            threads += [Thread(target=_ping, args=(i,)) for i in range(num)]
+            for thread in threads:
+                thread.start()
+            end = time() + deadline
+            matched = 0
+            while matched < num:
+                try:
+                    event = self._new_streams.get(
+                        timeout=max(end - time(), 0))
+                except Empty:
+                    break
+                i = ports.get(event.source_port)
+                # Streams left over from an earlier round are only closed.
+                if i is None or events[i] is not None or \
+                   event.arrived_at < started[i]:
+                    i = None
+                else:
+                    events[i] = event.arrived_at - started[i]
+                    matched += 1
+                thread = Thread(target=_close, args=(event, i))
+                thread.start()
+                threads.append(thread)
+            for thread in threads:
+                thread.join()
+            self._manager.write_calibration(Calibration(
+                date=datetime.utcnow(), workers=workers, socks=socks,
+                events=events, closes=closes, pings=pings))
+        self._controller.remove_event_listener(self._stream_new)
+
+
+class _ThroughputSampler(object):
+    """
+    Curl progress callback that samples the number of bytes received over
+    time into BW_SAMPLE_SLOTS slots. Once all slots are taken, every other
+    sample is dropped and the sampling interval doubles, so that the samples
+    always span the whole transfer.
+    """
+    def __init__(self):
+        self._times = array('I', [0]) * BW_SAMPLE_SLOTS
+        self._bytes = array('I', [0]) * BW_SAMPLE_SLOTS
+        self._num = 0
+        self._interval = BW_SAMPLE_INTERVAL
+        self._start = time()
+        self._next = self._start
+
+    def __call__(self, download_total, downloaded, upload_total, uploaded):
+        """ Take a sample if the sampling interval has passed. """
+        now = time()
+        if now < self._next:
+            return 0
+        self._next = now + self._interval
+        self._sample(now, downloaded)
+        return 0
+
+    def _sample(self, now, downloaded):
+        """ Store sample, halving the resolution if all slots are taken. """
+        if self._num == BW_SAMPLE_SLOTS:
+            self._num = BW_SAMPLE_SLOTS // 2
+            self._times[:self._num] = self._times[::2]
+            self._bytes[:self._num] = self._bytes[::2]
+            self._interval *= 2
+        self._times[self._num] = int(1000 * (now - self._start))
+        self._bytes[self._num] = int(downloaded)
+        self._num += 1
+
+    def samples(self, downloaded):
+        """
+        Take a final sample of the bytes downloaded and return ms since the
+        start of the transfer and bytes received so far, as two arrays in
+        chronological order.
+        """
+        self._sample(time(), downloaded)
+        return (self._times[:self._num], self._bytes[:self._num])
 
 
 class _Worker(Thread):
@@ -385,9 +1159,14 @@ class _Worker(Thread):
         "num_rttprobes": number of RTT probes for each circuit.
         "num_ttfbprobes": number of TTFB probes for each circuit.
         "probesleep": number of seconds to wait between probes.
+        "rttconcurrency": number of RTT probes in flight at once.
+        "rtthalfwidth": confidence half-width in ms to stop RTT probing at.
+        "rttminprobes": minimum number of RTTs for adaptive RTT probing.
+        "deadlines": deadlines in seconds for waiting in each stage.
     """
     def __init__(self, controller, manager, path, dest, num_rttprobes,
-                 num_ttfbprobes, num_bwprobes, probesleep):
+                 num_ttfbprobes, num_bwprobes, probesleep, rttconcurrency,
+                 rtthalfwidth, rttminprobes, deadlines):
         self._controller = controller
         self._manager = manager
         self.path = path
@@ -396,48 +1175,167 @@ class _Worker(Thread):
         self._num_ttfbprobes = num_ttfbprobes
         self._num_bwprobes = num_bwprobes
         self._probesleep = probesleep
+        self._rttconcurrency = rttconcurrency
+        self._rtthalfwidth = rtthalfwidth
+        self._rttminprobes = rttminprobes
+        self._deadlines = deadlines
+        self._waiting = dict()
+        self._reclaim_lock = Lock()
+        self.reason = None
         self._cid = None
         self._circuit_finished = Event()
         self._cbt_received = Event()
-        self._stream_finished = Event()
+        self._streams_finished = dict()
         self._circuit_built = Event()
+        # Slots of the manager and event listeners the worker holds, which
+        # are released if it fails.
+        self._slots = []
+        self._listeners = []
         Thread.__init__(self)
         self.start()
 
+    @property
+    def cid(self):
+        """ Identifier of the probed circuit. """
+        return self._cid
+
+    def _wait(self, event, stage):
+        """
+        Wait for event within the deadline of the given stage. Return False
+        if the worker has been reclaimed meanwhile.
+        """
+        self._waiting[event] = (stage, time() + self._deadlines[stage])
+        event.wait()
+        del self._waiting[event]
+        return self.reason is None
+
+    def expired(self, now):
+        """ Return the stage whose deadline has passed, if any. """
+        for stage, deadline in self._waiting.values():
+            if now > deadline:
+                return stage
+
+    def reclaim(self, reason):
+        """
+        Force-close the circuit and wake up all waits of the worker, which
+        then writes its incomplete probe with the given reason. Return False
+        if the worker has already been reclaimed.
+        """
+        with self._reclaim_lock:
+            if self.reason:
+                return False
+            self.reason = reason
+        # Workers only handle events of their own circuit identifier, so
+        # late events of the closed circuit are ignored.
+        if self._cid is not None:
+            try:
+                self._controller.close_circuit(self._cid)
+            except (InvalidArguments, InvalidRequest, OperationFailed):
+                pass
+        for event in [self._circuit_built, self._cbt_received,
+                      self._circuit_finished] + \
+                self._streams_finished.values():
+            event.set()
+        return True
+
+    def _reclaimed(self, probe, *listeners):
+        """ Remove listeners and write incomplete probe. """
+        for listener in listeners:
+            self._controller.remove_event_listener(listener)
+        if self._cid:
+            self._manager.cbts.cancel(self._cid)
+        self._manager.write(self, probe._replace(reason=self.reason),
+                            self._dest)
+
+    def _acquire(self, slot):
+        """ Acquire a slot of the manager. """
+        slot.acquire()
+        self._slots.append(slot)
+
+    def _release(self, slot):
+        """ Release a slot of the manager. """
+        self._slots.remove(slot)
+        slot.release()
+
+    def _listen(self, listener, event_type):
+        """ Add event listener, which is removed if the worker fails. """
+        self._listeners.append(listener)
+        self._controller.add_event_listener(listener, event_type)
+
     def _attach_stream(self, event):
-        """ Attach stream to circuit. """
-        try:
-            self._controller.attach_stream(event.id, self._cid)
-        except (OperationFailed, InvalidRequest), error:
-            error = str(error)
-            # If circuit is already closed, close stream too.
-            if error in (('Unknown circuit "%s"' % self._cid),
-                         "Can't attach stream to non-open origin circuit"):
-                self._controller.close_stream(event.id)
-            # Ignore the rare cases (~5*10^-7) where a stream has already been
-            # closed almost directly after its NEW-event has been received.
-            elif error == 'Unknown stream "%s"' % event.id:
-                sys.stderr.write('Stream %s has already been ' +
-                                 'closed.\n' % event.id)
-            else:
-                raise
+        """
+        Submit attaching stream to circuit. The event handler returns
+        without waiting for tor's reply.
+        """
+        self._manager.attacher.submit(event.id, self._cid,
+                                      self._stream_attached)
+
+    def _stream_attached(self, stream_id, circ_id, error):
+        """ Handle tor's reply to attaching stream to circuit. """
+        if not error:
+            return
+        reason = str(error)
+        # If circuit is already closed, close stream too.
+        if reason in (('Unknown circuit "%s"' % circ_id),
+                      "Can't attach stream to non-open origin circuit"):
+            self._controller.close_stream(stream_id)
+        # Ignore the rare cases (~5*10^-7) where a stream has already been
+        # closed almost directly after its NEW-event has been received.
+        elif reason == 'Unknown stream "%s"' % stream_id:
+            sys.stderr.write('Stream %s has already been closed.\n'
+                             % stream_id)
+        # Write the probe as failed instead of waiting for a deadline.
+        else:
+            sys.stderr.write('Attaching stream %s to circuit %s failed: %s\n'
+                             % (stream_id, circ_id, reason))
+            try:
+                self._controller.close_stream(stream_id)
+            except (InvalidArguments, InvalidRequest, OperationFailed):
+                pass
+            self.reclaim('FAILED_ATTACH')
 
     def run(self):
+        try:
+            self._probe()
+        except Exception:
+            sys.stderr.write('Worker of circuit %s failed:\n%s'
+                             % (self._cid, format_exc()))
+            for listener in self._listeners:
+                self._controller.remove_event_listener(listener)
+            if self._cid is not None:
+                self._manager.cbts.cancel(self._cid)
+                try:
+                    self._controller.close_circuit(self._cid)
+                except (InvalidArguments, InvalidRequest, OperationFailed):
+                    pass
+            self._manager.discard(self)
+        finally:
+            for slot in list(self._slots):
+                self._release(slot)
+
+    def _probe(self):
+        """ Build and probe the circuit, and write the probe. """
+        def _circuit_state(event):
+            """ Handle state of the probed circuit. """
+            probe.circs.append(event)
+            if self._circuit_built.is_set():
+                if event.status in ('FAILED', 'CLOSED'):
+                    self._circuit_finished.set()
+            if not self._circuit_built.is_set():
+                if event.status in ('FAILED', 'BUILT'):
+                    self._circuit_built.set()
+
         def _circuit_handler(event):
-            """ Event handler for handling circuit states. """
-            if not event.build_flags or 'IS_INTERNAL' not in event.build_flags:
-                if event.id == self._cid:
-                    probe.circs.append(event)
-                    if self._circuit_built.is_set():
-                        if event.status in ('FAILED', 'CLOSED'):
-                            self._circuit_finished.set()
-                    if not self._circuit_built.is_set():
-                        if event.status in ('FAILED', 'BUILT'):
-                            self._circuit_built.set()
-                elif event.status == 'LAUNCHED' and not self._cid:
-                    self._cid = event.id
-                    probe.circs.append(event)
-                    self._manager.circ_launched.release()
+            """
+            Event handler for handling circuit states. Events arriving before
+            tor replied with the circuit identifier are kept until then.
+            """
+            with launch_lock:
+                if self._cid is None:
+                    launch_events.append(event)
+                    return
+            if event.id == self._cid:
+                _circuit_state(event)
 
         def _stream_probing(event):
             """
@@ -445,11 +1343,40 @@ class _Worker(Thread):
             """
             if event.target_address == self._dest:
                 probe.streams.append(event)
+                rtt_streams[event.target_port].append(event)
                 if event.status == 'CLOSED':
-                    self._stream_finished.set()
+                    self._streams_finished[event.target_port].set()
                 elif event.status == 'NEW' and event.purpose == 'USER':
                     self._attach_stream(event)
 
+        def _rtt_probe(port):
+            """ Probe RTT with a stream to the given destination port. """
+            try:
+                socket = socksocket()
+                socket.setproxy(PROXY_TYPE_SOCKS5, socks_ip, socks_port)
+                socket.settimeout(self._deadlines['STREAM'])
+                try:
+                    socket.connect((self._dest, port))
+                except socket_timeout:
+                    pass
+                except Socks5Error, error:
+                    # tor's socks implementation sends a general error
+                    # response when the Tor protocol is violated.
+                    # See stream_end_reason_to_socks5_response()
+                    err = ("(1, 'general SOCKS server failure')",
+                           "(5, 'Connection refused')",
+                           "(6, 'TTL expired')")
+                    if str(error) not in err:
+                        raise Socks5Error(str(error))
+                # Make sure stream has been closed.
+                self._wait(self._streams_finished[port], 'STREAM')
+                socket.close()
+                rtt = _stream_rtt(rtt_streams[port])
+                if rtt is not None:
+                    rtts.append(rtt)
+            finally:
+                rtt_slots.release()
+
         def _stream_performance(event):
             """ Event handler for detecting start of performance stream. """
             # Make sure we don't handle a probing stream.
@@ -468,15 +1395,12 @@ class _Worker(Thread):
                     self._attach_stream(event)
                     self._manager.bw_lock.release()
 
-        def _cbt_check(event):
-            """ Check for CBT message from tor. """
-            cbt_m = match('^circuit_send_next_onion_skin\(\): circuit '
-                          '([0-9]+) built in ([0-9]+)msec $', (event.message))
-            if cbt_m and cbt_m.group(1) == self._cid:
-                assert len(probe.cbt) == 0, \
-                    'CBT for %s is already set: %d.' % (self._cid, probe.cbt)
-                probe.cbt.add(int(cbt_m.group(2)))
-                self._cbt_received.set()
+        def _cbt_set(cbt):
+            """ Store CBT of circuit extracted from tor's log. """
+            assert len(probe.cbt) == 0, \
+                'CBT for %s is already set: %s.' % (self._cid, probe.cbt)
+            probe.cbt.add(cbt)
+            self._cbt_received.set()
 
         def devnull(body):
             """ Drop Curl output. """
@@ -486,52 +1410,83 @@ class _Worker(Thread):
         socks_port = self._controller.get_socks_listeners()[0][1]
 
         probe = Probe(path=self.path, circs=[], cbt=set(), streams=[],
-                      perf=[], bw=[])
+                      perf=[], bw=[], bwsamples=[])
 
-        # Build new circuit.
+        # Build new circuit. Building and probing are separate stages with
+        # their own concurrency limits, so that circuits can be built ahead
+        # while others are probed.
+        self._acquire(self._manager.build_slots)
         circ_path = [node.desc.fingerprint for node in self.path]
-        # Launching a circuit must be exclusive since we get the circuit
-        # identifier from the LAUNCH event.
-        self._manager.circ_launched.acquire()
-        self._controller.add_event_listener(_circuit_handler, EventType.CIRC)
-        self._controller.add_event_listener(_cbt_check, EventType.INFO)
-        self._controller.extend_circuit(path=circ_path)
-        self._circuit_built.wait()
+        # The LAUNCHED event may arrive before tor's reply to extending the
+        # circuit, which tells its identifier.
+        launch_lock = Lock()
+        launch_events = []
+        self._listen(_circuit_handler, EventType.CIRC)
+        cid = self._controller.extend_circuit(path=circ_path)
+        with launch_lock:
+            self._cid = cid
+            for event in launch_events:
+                if event.id == cid:
+                    _circuit_state(event)
+        self._manager.cbts.expect(cid, _cbt_set)
+        if not self._wait(self._circuit_built, 'BUILD'):
+            self._release(self._manager.build_slots)
+            return self._reclaimed(probe, _circuit_handler)
         build_status = probe.circs[len(probe.circs) - 1].status
         assert build_status == 'BUILT' or build_status == 'FAILED', \
             'Wrong circuit status: %s.' % build_status
         if build_status == 'FAILED':
             self._controller.remove_event_listener(_circuit_handler)
-            self._controller.remove_event_listener(_cbt_check)
+            self._manager.cbts.cancel(self._cid)
+            self._release(self._manager.build_slots)
             self._manager.write(self, probe, self._dest)
             return
 
         # Make sure CBT has been set
-        self._cbt_received.wait()
-        self._controller.remove_event_listener(_cbt_check)
-
-        # RTT probe circuit.
-        for _ in range(0, self._num_rttprobes):
-            self._stream_finished.clear()
-            socket = socksocket()
-            socket.setproxy(PROXY_TYPE_SOCKS5, socks_ip, socks_port)
-            self._controller.add_event_listener(_stream_probing,
-                                                EventType.STREAM)
-            try:
-                socket.connect((self._dest, 80))
-            except Socks5Error, error:
-                # tor's socks implementation sends a general error response
-                # when the Tor protocol is violated.
-                # See stream_end_reason_to_socks5_response()
-                err = ("(1, 'general SOCKS server failure')",
-                       "(5, 'Connection refused')",
-                       "(6, 'TTL expired')")
-                if str(error) not in err:
-                    raise Socks5Error(str(error))
-            # Make sure stream has been closed.
-            self._stream_finished.wait()
-            self._controller.remove_event_listener(_stream_probing)
-            socket.close()
+        if not self._wait(self._cbt_received, 'CBT'):
+            self._release(self._manager.build_slots)
+            return self._reclaimed(probe, _circuit_handler)
+        self._release(self._manager.build_slots)
+
+        # Wait for the probe stage to take over the built circuit.
+        self._acquire(self._manager.probe_slots)
+
+        # RTT probe circuit. Up to self._rttconcurrency probes are in
+        # flight at once, their streams are told apart by destination port.
+        # With adaptive sampling, stop as soon as the RTTs of the finished
+        # probes are tight enough.
+        rtt_slots = Semaphore(self._rttconcurrency)
+        rtt_probes = []
+        rtt_streams = dict()
+        rtts = []
+        stop = 'MAXIMUM'
+        self._listen(_stream_probing, EventType.STREAM)
+        for port in range(RTT_PORT, RTT_PORT + self._num_rttprobes):
+            rtt_slots.acquire()
+            if self.reason:
+                rtt_slots.release()
+                break
+            if self._rtthalfwidth is not None and \
+               len(rtts) >= self._rttminprobes and \
+               _halfwidth(rtts) <= self._rtthalfwidth:
+                rtt_slots.release()
+                stop = 'HALFWIDTH'
+                break
+            rtt_streams[port] = []
+            self._streams_finished[port] = Event()
+            rtt_probe = Thread(target=_rtt_probe, args=(port,))
+            rtt_probe.start()
+            rtt_probes.append(rtt_probe)
+        for rtt_probe in rtt_probes:
+            rtt_probe.join()
+        self._controller.remove_event_listener(_stream_probing)
+        if self._rtthalfwidth is not None:
+            probe = probe._replace(rttstop=RTTStop(reason=stop,
+                                                   samples=len(rtt_probes),
+                                                   halfwidth=_halfwidth(rtts)))
+        if self.reason:
+            self._release(self._manager.probe_slots)
+            return self._reclaimed(probe, _circuit_handler)
 
         # TTFB probe circuit
         for _ in range(0, self._num_ttfbprobes):
@@ -548,8 +1503,7 @@ class _Worker(Thread):
             curl.setopt(curl.HEADERFUNCTION, devnull)
             curl.setopt(curl.URL, 'http://www.google.com/')
             self._manager.perf_lock.acquire()
-            self._controller.add_event_listener(_stream_performance,
-                                                EventType.STREAM)
+            self._listen(_stream_performance, EventType.STREAM)
             try:
                 # self._manager.perf_lock is released in _stream_performance
                 # from here
@@ -579,6 +1533,7 @@ class _Worker(Thread):
             curl.close()
 
         # Bandwidth probe circuit
+        null = open(null_device, 'wb')
         for _ in range(0, self._num_bwprobes):
             self._manager.bw_lock.acquire()
             curl = pycurl.Curl()
@@ -586,17 +1541,26 @@ class _Worker(Thread):
             curl.setopt(curl.CONNECTTIMEOUT, 120)
             curl.setopt(curl.TIMEOUT, 3600)
             curl.setopt(curl.URL, 'http://www.torrtt.info/')
-            curl.setopt(curl.WRITEFUNCTION, devnull)
+            # Curl writes the response body to /dev/null itself, which saves
+            # the Python call per chunk that the progress sampling adds.
+            curl.setopt(curl.WRITEDATA, null)
             curl.setopt(pycurl.USERAGENT, "")
             # No compression of HTTP response
             curl.setopt(pycurl.ENCODING, "identity")
-            self._controller.add_event_listener(_stream_bw, EventType.STREAM)
+            curl.setopt(curl.NOPROGRESS, 0)
+            self._listen(_stream_bw, EventType.STREAM)
+            sampler = _ThroughputSampler()
+            curl.setopt(curl.PROGRESSFUNCTION, sampler)
             try:
                 curl.perform()
             except pycurl.error, errorstr:
                 probe.bw.append([str(errorstr)])
+                probe.bwsamples.append(
+                    sampler.samples(curl.getinfo(pycurl.SIZE_DOWNLOAD)))
                 curl.close()
                 continue
+            probe.bwsamples.append(
+                sampler.samples(curl.getinfo(pycurl.SIZE_DOWNLOAD)))
             if curl.getinfo(pycurl.SIZE_DOWNLOAD) != 5242880.0:
                 probe.bw.append(['Wrong response length: %0.2f'
                                  % pycurl.SIZE_DOWNLOAD])
@@ -616,6 +1580,9 @@ class _Worker(Thread):
                                  curl.getinfo(pycurl.STARTTRANSFER_TIME),
                                  curl.getinfo(pycurl.TOTAL_TIME)])
             curl.close()
+        null.close()
+
+        self._release(self._manager.probe_slots)
 
         # close circuit, but ignore if it does not exist anymore
         try:
@@ -624,7 +1591,8 @@ class _Worker(Thread):
             pass
 
         # Make sure circuit has finished.
-        self._circuit_finished.wait()
+        if not self._wait(self._circuit_finished, 'CLOSE'):
+            return self._reclaimed(probe, _circuit_handler)
         self._controller.remove_event_listener(_circuit_handler)
 
         # Output probe data
@@ -648,10 +1616,47 @@ def _main():
     parser.add_argument("--bwprobes", type=int, default=1,
                         help="Number of throughput measurements on each " +
                              "circuit.")
+    parser.add_argument("--rttconcurrency", type=int, default=1,
+                        help="Number of RTT measurements in flight at once " +
+                             "on each circuit.")
+    parser.add_argument("--rtthalfwidth", type=float, default=None,
+                        help="Stop RTT measurements on a circuit as soon as " +
+                             "the 95%% confidence half-width of its mean " +
+                             "RTT in ms is reached (--rttprobes is the " +
+                             "maximum then).")
+    parser.add_argument("--rttminprobes", type=int, default=5,
+                        help="Minimum number of successful RTT " +
+                             "measurements before --rtthalfwidth applies.")
     parser.add_argument("--probesleep", type=float, default=0,
                         help="Waiting interval between probes in seconds.")
     parser.add_argument("--threads", type=int, default=1,
                         help="Number of parallel measurement threads.")
+    parser.add_argument("--prebuild", type=int, default=0,
+                        help="Number of circuits built ahead while " +
+                             "--threads circuits are measured.")
+    parser.add_argument("--buildthreads", type=int, default=None,
+                        help="Number of circuits built at once (default: " +
+                             "--threads + --prebuild).")
+    for stage in sorted(DEADLINES):
+        parser.add_argument("--%sdeadline" % stage.lower(), type=float,
+                            default=DEADLINES[stage], dest=stage,
+                            help="Seconds to wait for tor in stage %s " %
+                                 stage + "before reclaiming the worker.")
+    parser.add_argument("--oracle", type=str, default=None,
+                        help="Serve the fastest paths predicted from live " +
+                             "measurements on this Unix socket and keep " +
+                             "running until interrupted.")
+    parser.add_argument("--scheduler", choices=('findpath', 'coverage'),
+                        default='findpath',
+                        help="Paths from tor's bandwidth-weighted path " +
+                             "selection (findpath) or explicit paths of " +
+                             "the least measured relays (coverage).")
+    parser.add_argument("--control", type=str, default=None,
+                        help="Unix socket for changing parameters, " +
+                             "pausing, resuming and draining at runtime.")
+    parser.add_argument("--calibrate", type=float, default=None,
+                        help="Measure local SOCKS and control port " +
+                             "overhead every this many seconds.")
     parser.add_argument("--output", type=str, default='probe_',
                         help="Prefix for output files.")
     parser.add_argument('--network-protection', dest='network_protection',
@@ -662,18 +1667,31 @@ def _main():
                                                    "the Tor network.")
     parser.add_argument("--port", type=int, default=9051,
                         help="tor control port.")
+    parser.add_argument("--controllers", type=int, default=0,
+                        help="Number of additional control connections " +
+                             "for commands (0: share the event connection).")
+    parser.add_argument("--password", action='store_true',
+                        help="Prompt for the password of tor's control port.")
     parser.set_defaults(network_protection=True)
     args = parser.parse_args()
 
-    controller = connect_port(port=args.port)
+    password = None
+    if args.password:
+        password = getpass('Control port password: ')
+    controller = connect_port(port=args.port, password=password)
     if not controller:
         sys.stderr.write("ERROR: Couldn't connect to tor.\n")
         sys.exit(1)
     if not controller.is_authenticated():
-        controller.authenticate()
+        controller.authenticate(password=password)
     NavigaTor(controller, args.circuits, args.rttprobes, args.ttfbprobes,
               args.bwprobes, args.probesleep, args.threads, args.output,
-              args.network_protection)
+              args.network_protection, args.controllers, args.rttconcurrency,
+              args.rtthalfwidth, args.rttminprobes, args.prebuild,
+              args.buildthreads,
+              dict((stage, getattr(args, stage)) for stage in DEADLINES),
+              args.oracle, args.scheduler, args.control, args.calibrate,
+              password)
     controller.close()
 
 
@@ -0,0 +1,353 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks on synthetic data, so that changes to the tools can be measured
+without tor. Probes are built from stem's own classes, with descriptors
+lazily loaded as when they are received from tor.
+"""
+
+# Author: Robert Annessi <robert.annessi@nt.tuwien.ac.at>
+# License: GPLv2 (2016)
+
+import sys
+from cPickle import dumps, HIGHEST_PROTOCOL
+from argparse import ArgumentParser
+from random import Random
+from StringIO import StringIO
+from datetime import timedelta
+from calendar import timegm
+from stat import S_IMODE
+from threading import Thread, Lock
+from time import sleep, time
+from re import match
+import tarfile
+
+from lzo import compress
+from stem.response import ControlMessage
+from stem.control import EventType
+
+from NavigaTor import DEADLINES, _Manager, _CBTExtractor
+from testdata import SYNTHETIC_START, synthetic_relays, synthetic_probe
+
+
+# INFO messages of tor besides CBTs, as logged while measuring.
+INFO_MESSAGES = (
+    "circuit_finish_handshake(): Finished building circuit hop:",
+    "internal circ (length 3, last hop Unnamed): $%s(open) $%s(open) "
+    "$%s(open)" % ('A' * 40, 'B' * 40, 'C' * 40),
+    "connection_edge_process_relay_cell_not_open(): 'connected' received "
+    "for circid 3259478573 streamid 51322 after 0 seconds.",
+    "connection_ap_handshake_send_begin(): Sending relay cell 0 on circ "
+    "3259478573 to begin stream 51322.",
+    "command_process_created_cell(): at OP. Finishing handshake.",
+    "channel_tls_process_netinfo_cell(): Got good NETINFO cell from "
+    "10.0.0.1; OR connection is now open, using protocol version 4.")
+
+
+def _event(line, arrived_at=None):
+    """ Parse an asynchronous event of tor's control protocol. """
+    return ControlMessage.from_str('650 %s\r\n' % line, 'EVENT',
+                                   arrived_at=arrived_at)
+
+
+def _archive(args):
+    """ Write an archive of synthetic probes to stdout. """
+    rng = Random(args.seed)
+    relays = synthetic_relays(args.relays, rng)
+    tar = tarfile.open(fileobj=sys.stdout, mode='w|')
+    for num in range(args.probes):
+        data, dest = synthetic_probe(num, relays, rng, args.rttprobes)
+        data = compress(dumps(data, HIGHEST_PROTOCOL))
+        info = tarfile.TarInfo()
+        info.name = 'Probe_%s.lzo' % dest
+        info.size = len(data)
+        info.mode = S_IMODE(0o0444)
+        created = SYNTHETIC_START + timedelta(seconds=num)
+        info.mtime = timegm(created.timetuple())
+        tar.addfile(tarinfo=info, fileobj=StringIO(data))
+    tar.close()
+
+
+class _Controller(object):
+    """
+    Stand-in for the parts of a Tor controller the manager uses. Events are
+    dispatched to all listeners, whatever their type.
+    """
+    def __init__(self):
+        self._listeners = []
+
+    def __len__(self):
+        return 1
+
+    def add_event_listener(self, listener, *events):
+        self._listeners.append(listener)
+
+    def remove_event_listener(self, listener):
+        self._listeners.remove(listener)
+
+    def stats(self):
+        return 'synthetic'
+
+    def emit(self, event):
+        """ Call all listeners with event, as stem's event thread does. """
+        for listener in self._listeners:
+            listener(event)
+
+
+class _SimulatedWorker(Thread):
+    """
+    Worker that probes its circuit by sleeping for the given seconds, and
+    then writes the probe.
+    """
+    def __init__(self, manager, path, dest, probe, duration):
+        self._manager = manager
+        self.path = path
+        self.cid = None
+        self._dest = dest
+        self._probe = probe._replace(path=path)
+        self._duration = duration
+        Thread.__init__(self)
+        self.start()
+
+    def expired(self, now):
+        return None
+
+    def run(self):
+        sleep(self._duration)
+        self._manager.write(self, self._probe, self._dest)
+
+
+class _SlowOutput(object):
+    """
+    Output file that discards data, but takes the given seconds for each
+    write while holding lock.
+    """
+    def __init__(self, writetime, lock):
+        self._writetime = writetime
+        self._lock = lock
+
+    def write(self, data):
+        with self._lock:
+            sleep(self._writetime)
+
+    def close(self):
+        pass
+
+
+class _SimulatedManager(_Manager):
+    """
+    Manager whose path finding, workers and output take simulated time, and
+    which records the time each worker spends writing its probe.
+        "relays": relays that paths are chosen from.
+        "probes": probes that workers write, with their path replaced.
+        "pathtime": seconds finding a path takes.
+        "probetime": mean seconds probing a circuit takes.
+        "writetime": seconds each write to the output takes.
+        "single": whether path finding and output share one lock, as they
+                  did before _Manager's lock was split.
+    """
+    def __init__(self, relays, probes, pathtime, probetime, writetime,
+                 single, rng, *args):
+        self._synthetic = relays
+        self._probes = probes
+        self._pathtime = pathtime
+        self._probetime = probetime
+        self._writetime = writetime
+        self._path_lock = Lock()
+        self._write_lock = self._path_lock if single else Lock()
+        self._rng = rng
+        self.latencies = []
+        _Manager.__init__(self, *args)
+
+    def _create_tar_file(self):
+        return tarfile.open(mode='w|', fileobj=_SlowOutput(self._writetime,
+                                                           self._write_lock))
+
+    def _get_new_path(self):
+        with self._path_lock:
+            sleep(self._pathtime)
+        return [self._rng.choice(self._synthetic[0::3]),
+                self._rng.choice(self._synthetic[1::3]),
+                self._rng.choice(self._synthetic[2::3])]
+
+    def start_worker(self, path, dest):
+        thread = _SimulatedWorker(self, path, dest,
+                                  self._rng.choice(self._probes),
+                                  self._rng.expovariate(1 / self._probetime))
+        with self._sched_lock:
+            self._threads.add(thread)
+
+    def write(self, worker, probe, dest):
+        start = time()
+        _Manager.write(self, worker, probe, dest)
+        self.latencies.append(time() - start)
+
+
+def _manager(args):
+    """
+    Schedule circuits with the manager, whose path finding, workers and
+    output take simulated time, once with its scheduling and output locks
+    and once with a single lock for both as before they were split. Report
+    the throughput and the time workers spend writing their probes.
+    """
+    for name, single in (('Split locks', False), ('Single lock', True)):
+        rng = Random(args.seed)
+        relays = synthetic_relays(args.relays, rng)
+        probes = [synthetic_probe(num, relays, rng)[0]
+                  for num in range(64)]
+        start = time()
+        manager = _SimulatedManager(
+            relays, probes, args.pathtime / 1000.0, args.probetime / 1000.0,
+            args.writetime / 1000.0, single, rng, _Controller(),
+            args.circuits, 0, 0, 0, 0, args.threads, None, True, 1, None, 5,
+            0, args.threads, DEADLINES, None, 'findpath', None)
+        manager.join()
+        duration = time() - start
+        latencies = sorted(manager.latencies)
+        sys.stdout.write('%s: %d circuits in %.1f s (%.1f circuits/s).\n'
+                         % (name, len(latencies), duration,
+                            len(latencies) / duration))
+        sys.stdout.write('%s: writing a probe: mean %.2f ms, median %.2f '
+                         'ms, maximum %.2f ms.\n'
+                         % (name, 1000 * sum(latencies) / len(latencies),
+                            1000 * latencies[len(latencies) // 2],
+                            1000 * latencies[-1]))
+
+
+def _info_events(num, workers, ratio):
+    """
+    Return num INFO events. Every ratio-th is the CBT of one of the
+    workers' circuits, in turns.
+    """
+    events = []
+    for i in range(num):
+        if i % ratio == ratio - 1:
+            message = 'circuit_send_next_onion_skin(): circuit %d built in ' \
+                '%dmsec ' % (i // ratio % workers, 200 + i % 3000)
+        else:
+            message = INFO_MESSAGES[i % len(INFO_MESSAGES)]
+        events.append(_event('INFO %s' % message))
+    return events
+
+
+def _per_worker(controller, workers, received):
+    """
+    Add an INFO listener for the circuit of each worker that matches every
+    message, as workers checked for their CBTs before sharing an extractor.
+    """
+    def listener(cid):
+        """ Return the listener of the worker of circuit cid. """
+        def check(event):
+            cbt_m = match(r'^circuit_send_next_onion_skin\(\): circuit '
+                          r'([0-9]+) built in ([0-9]+)msec $', event.message)
+            if cbt_m and cbt_m.group(1) == cid:
+                received.append(int(cbt_m.group(2)))
+        return check
+    for cid in range(workers):
+        controller.add_event_listener(listener(str(cid)), EventType.INFO)
+
+
+def _shared(controller, workers, received):
+    """
+    Register the circuit of each worker with one extractor. Workers wait
+    for the next CBT of their circuit once they received one.
+    """
+    cbts = _CBTExtractor(controller)
+
+    def expect(cid):
+        """ Wait for the next CBT of circuit cid. """
+        def callback(cbt):
+            received.append(cbt)
+            cbts.expect(cid, callback)
+        cbts.expect(cid, callback)
+    for cid in range(workers):
+        expect(str(cid))
+
+
+def _cbt(args):
+    """
+    Dispatch INFO events to per-worker CBT listeners and to the shared
+    extractor, and report the time per event of each.
+    """
+    events = _info_events(args.events, args.workers, args.ratio)
+    results = []
+    for name, register in (('Per-worker listeners', _per_worker),
+                           ('Shared extractor', _shared)):
+        controller = _Controller()
+        received = []
+        register(controller, args.workers, received)
+        start = time()
+        for event in events:
+            controller.emit(event)
+        duration = time() - start
+        results.append(len(received))
+        sys.stdout.write('%s: %.2f us per event, %d CBTs.\n'
+                         % (name, 1e6 * duration / len(events),
+                            len(received)))
+    assert results[0] == results[1], 'Different numbers of CBTs received.'
+
+
+def _main():
+    """ Run the benchmark given on the command line. """
+    parser = ArgumentParser(description="Benchmarks on synthetic data.")
+    benchmarks = parser.add_subparsers(dest='benchmark')
+    archive = benchmarks.add_parser(
+        'archive', help="Write an archive of synthetic probes to stdout, "
+        "e.g., to measure the throughput of truncatedata and testdata.")
+    archive.add_argument("--probes", type=int, default=10000,
+                         help="Number of probes.")
+    archive.add_argument("--relays", type=int, default=300,
+                         help="Number of relays paths are chosen from.")
+    archive.add_argument("--rttprobes", type=int, default=10,
+                         help="Number of RTT probes of each probe.")
+    archive.add_argument("--seed", type=int, default=0,
+                         help="Seed of the random numbers.")
+    manager = benchmarks.add_parser(
+        'manager', help="Schedule circuits whose path finding, probing and "
+        "output take simulated time, with split locks and with a single "
+        "lock, and report the throughput and the time workers spend "
+        "writing their probes.")
+    manager.add_argument("--circuits", type=int, default=2000,
+                         help="Number of circuits.")
+    manager.add_argument("--threads", type=int, default=50,
+                         help="Number of circuits probed at once.")
+    manager.add_argument("--pathtime", type=float, default=2,
+                         help="Milliseconds finding a path takes.")
+    manager.add_argument("--probetime", type=float, default=200,
+                         help="Mean milliseconds probing a circuit takes.")
+    manager.add_argument("--writetime", type=float, default=5,
+                         help="Milliseconds each write to the output takes.")
+    manager.add_argument("--relays", type=int, default=300,
+                         help="Number of relays paths are chosen from.")
+    manager.add_argument("--seed", type=int, default=0,
+                         help="Seed of the random numbers.")
+    cbt = benchmarks.add_parser(
+        'cbt', help="Dispatch INFO events to the CBT listeners of waiting "
+        "workers, one per worker or one shared extractor, and report the "
+        "time per event.")
+    cbt.add_argument("--workers", type=int, default=50,
+                     help="Number of workers waiting for their CBT.")
+    cbt.add_argument("--events", type=int, default=20000,
+                     help="Number of INFO events.")
+    cbt.add_argument("--ratio", type=int, default=100,
+                     help="One in this many INFO events is a CBT.")
+    args = parser.parse_args()
+    if args.benchmark == 'archive':
+        assert args.probes > 0, 'Invalid number of probes.'
+        assert args.relays >= 3, 'Invalid number of relays.'
+        _archive(args)
+    elif args.benchmark == 'manager':
+        assert args.circuits > 0, 'Invalid number of circuits.'
+        assert args.relays >= 3, 'Invalid number of relays.'
+        assert args.threads > 0, 'Invalid number of threads.'
+        _manager(args)
+    elif args.benchmark == 'cbt':
+        assert args.workers > 0, 'Invalid number of workers.'
+        assert args.events > 0, 'Invalid number of events.'
+        assert args.ratio > 0, 'Invalid ratio.'
+        _cbt(args)
+
+
+if __name__ == '__main__':
+    _main()
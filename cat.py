@@ -2,24 +2,98 @@
 # -*- coding: utf-8 -*-
 
 """
-Calculate congestion delay for circuit.
+Calculate congestion delay for circuit. Probes are streamed from input to
+output, so that only the congestion delays of relays are kept in memory.
 """
 
 # Author: Robert Annessi <robert.annessi@nt.tuwien.ac.at>
 # License: GPLv2 (2015-2016)
 
 
+import sys
 from cPickle import load
 from argparse import ArgumentParser
-from numpy import average
+from math import fsum
 from os.path import exists
 from cPickle import dump, HIGHEST_PROTOCOL
 from collections import namedtuple
 
+from testdata import pickles
+
 
 Probedata = namedtuple('Probedata', 'date entry middle exit cbt rtts perfs bws cong')
 
 
+class _Ring(object):
+    """
+    Last congestion delays of a relay in a ring buffer with their running
+    sum, so that adding a value and averaging take O(1).
+        "size": maximum number of values.
+        "values": initial values, oldest first.
+    """
+    __slots__ = ('_values', '_next', '_len', '_sum')
+
+    def __init__(self, size, values=()):
+        self._values = [0.0] * size
+        self._next = 0
+        self._len = 0
+        self._sum = 0.0
+        for value in values:
+            self.append(value)
+
+    def __len__(self):
+        return self._len
+
+    def append(self, value):
+        """ Add value and drop the oldest one if the buffer is full. """
+        size = len(self._values)
+        if self._len == size:
+            self._sum -= self._values[self._next]
+        else:
+            self._len += 1
+        self._values[self._next] = value
+        self._sum += value
+        self._next = (self._next + 1) % size
+        # Recompute the sum once per round to keep rounding errors bounded.
+        if self._next == 0:
+            self._sum = fsum(self._values[:self._len])
+
+    def clear(self):
+        """ Drop all values. """
+        self._next = 0
+        self._len = 0
+        self._sum = 0.0
+
+    def values(self):
+        """ Return values, oldest first. """
+        first = (self._next - self._len) % len(self._values)
+        return [self._values[(first + i) % len(self._values)]
+                for i in range(self._len)]
+
+    def average(self):
+        """ Average of values. """
+        return self._sum / self._len
+
+
+def _load_state(path, size):
+    """ Load congestion delays of relays saved by _save_state(). """
+    with open(path, 'rb') as f:
+        state = load(f)
+    return dict((relay, _Ring(size, values))
+                for relay, values in state.iteritems())
+
+
+def _save_state(path, relay_congestion):
+    """
+    Save congestion delays of relays as a plain dict of fingerprints to
+    lists of values, oldest first.
+    """
+    state = dict((relay, ring.values())
+                 for relay, ring in relay_congestion.iteritems())
+    with open(path, 'wb') as f:
+        dump(state, f, HIGHEST_PROTOCOL)
+
+
 def _main():
     # found empirically by CAT authors
     gamma = 20
@@ -31,27 +105,27 @@ def _main():
     # initialization value (medmed congestion delay of nodes ~= 5)
     cong_init = 5
 
-    relay_congestion = dict()
-
     parser = ArgumentParser(description="")
-    parser.add_argument("--input", type=str, required=True,
-                        help="Input file.")
-    parser.add_argument("--output", type=str, required=True,
-                        help="Output file.")
+    parser.add_argument("--input", type=str,
+                        help="Input file (default: stdin).")
+    parser.add_argument("--output", type=str,
+                        help="Output file (default: stdout).")
+    parser.add_argument("--state", type=str,
+                        help="File the congestion delays of relays are "
+                        "loaded from, if it exists, and saved to.")
     args = parser.parse_args()
-    assert exists(args.input), 'Invalid input file.'
-    assert not exists(args.output), 'Invalid output file.'
-
-    probes = []
-    with open(args.input, 'r') as f:
-        while True:
-            try:
-                probes.append(load(f))
-            except EOFError:
-                break
-
-    with open(args.output, 'w') as f:
-        for probe in probes:
+    assert not args.input or exists(args.input), 'Invalid input file.'
+    assert not args.output or not exists(args.output), \
+        'Invalid output file.'
+
+    relay_congestion = dict()
+    if args.state and exists(args.state):
+        relay_congestion = _load_state(args.state, L)
+
+    infile = open(args.input, 'rb') if args.input else sys.stdin
+    output = open(args.output, 'wb') if args.output else sys.stdout
+    try:
+        for probe in pickles(infile):
             # Check type and number of RTT measurements
             rtts = [rtt for rtt in probe.rtts if isinstance(rtt, int)]
             if len(rtts) != 5:
@@ -60,13 +134,16 @@ def _main():
                                       cbt=probe.cbt, rtts=probe.rtts,
                                       perfs=probe.perfs, bws=probe.bws,
                                       cong=None)
-                dump(probedata, f, HIGHEST_PROTOCOL)
+                dump(probedata, output, HIGHEST_PROTOCOL)
                 continue
 
             # Create congestion entry for relay if it does not exist yet.
             for i in probe.entry, probe.middle, probe.exit:
                 if i not in relay_congestion:
-                    relay_congestion[i] = [cong_init]
+                    relay_congestion[i] = _Ring(L, [cong_init])
+            entry = relay_congestion[probe.entry]
+            middle = relay_congestion[probe.middle]
+            exit_ = relay_congestion[probe.exit]
 
             # Get reference value and remove it from the list for comparison
             t_min = min(rtts)
@@ -75,35 +152,43 @@ def _main():
             for rtt in rtts:
                 # calculate congestion delay for each node
                 T_c = rtt - t_min + gamma
-                t_c_1 = T_c * 2 * average(relay_congestion[probe.entry]) / (2 * average(relay_congestion[probe.entry]) + 2 * average(relay_congestion[probe.middle]) + average(relay_congestion[probe.exit]))
-                t_c_2 = T_c * 2 * average(relay_congestion[probe.middle]) / (2 * average(relay_congestion[probe.entry]) + 2 * average(relay_congestion[probe.middle]) + average(relay_congestion[probe.exit]))
-                t_c_3 = T_c * average(relay_congestion[probe.exit]) / (2 * average(relay_congestion[probe.entry]) + 2 * average(relay_congestion[probe.middle]) + average(relay_congestion[probe.exit]))
+                avg_entry = entry.average()
+                avg_middle = middle.average()
+                avg_exit = exit_.average()
+                total = 2 * avg_entry + 2 * avg_middle + avg_exit
+                t_c_1 = T_c * 2 * avg_entry / total
+                t_c_2 = T_c * 2 * avg_middle / total
+                t_c_3 = T_c * avg_exit / total
 
                 # delete initialization value if still present
-                for i in probe.entry, probe.middle, probe.exit:
-                    if len(relay_congestion[i]) == 1 and relay_congestion[i][0] == cong_init:
-                        del relay_congestion[i][0]
-
-                # add new congestion delays to nodes and delete oldest value
-                # if max number of measurements is reached
-                relay_congestion[probe.entry].append(t_c_1)
-                if len(relay_congestion[probe.entry]) > L:
-                    del relay_congestion[probe.entry][0]
-                relay_congestion[probe.middle].append(t_c_2)
-                if len(relay_congestion[probe.middle]) > L:
-                    del relay_congestion[probe.middle][0]
-                relay_congestion[probe.exit].append(t_c_3)
-                if len(relay_congestion[probe.exit]) > L:
-                    del relay_congestion[probe.exit][0]
+                for ring in entry, middle, exit_:
+                    if len(ring) == 1 and ring.values()[0] == cong_init:
+                        ring.clear()
+
+                # add new congestion delays to nodes, which deletes the
+                # oldest value if max number of measurements is reached
+                entry.append(t_c_1)
+                middle.append(t_c_2)
+                exit_.append(t_c_3)
 
             # calculate congestion delay for circuit
-            congestion = average(relay_congestion[probe.entry]) + average(relay_congestion[probe.middle]) + average(relay_congestion[probe.exit])
+            congestion = entry.average() + middle.average() + \
+                exit_.average()
             probedata = Probedata(date=probe.date, entry=probe.entry,
                                   middle=probe.middle, exit=probe.exit,
                                   cbt=probe.cbt, rtts=probe.rtts,
                                   perfs=probe.perfs, bws=probe.bws,
                                   cong=int(round(congestion)))
-            dump(probedata, f, HIGHEST_PROTOCOL)
+            dump(probedata, output, HIGHEST_PROTOCOL)
+    finally:
+        output.flush()
+        if args.input:
+            infile.close()
+        if args.output:
+            output.close()
+
+    if args.state:
+        _save_state(args.state, relay_congestion)
 
 
 if __name__ == '__main__':
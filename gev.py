@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Fit the generalized extreme value (GEV) distribution by maximum likelihood
+and evaluate its CDF with NumPy. Parameters follow VGAM's egev and pgev:
+    F(x) = exp(-(1 + shape * (x - location) / scale) ** (-1 / shape))
+"""
+
+# Author: Robert Annessi <robert.annessi@nt.tuwien.ac.at>
+# License: GPLv2 (2016)
+
+
+import numpy as np
+from scipy.optimize import minimize
+
+
+EULER_GAMMA = 0.5772156649015329
+# Shapes closer to zero than this are moved away from it, where the GEV
+# terms cancel out numerically.
+SHAPE_EPS = 1e-7
+# Maximum number of iterations of the optimizer.
+MAX_ITER = 200
+# Gradient norm per value at which the optimizer stops.
+GTOL = 1e-6
+
+
+def _shape(shape):
+    """ Keep shape away from zero. """
+    if abs(shape) < SHAPE_EPS:
+        return SHAPE_EPS if shape >= 0 else -SHAPE_EPS
+    return shape
+
+
+def _nll(params, x):
+    """
+    Negative log-likelihood of GEV and its gradient with respect to
+    (location, log(scale), shape). Infinite outside the support.
+    """
+    location, log_scale, shape = params
+    shape = _shape(shape)
+    scale = np.exp(log_scale)
+    z = (x - location) / scale
+    t = 1 + shape * z
+    if not np.all(t > 0):
+        return np.inf, np.zeros(3)
+    log_t = np.log(t)
+    y = np.exp(-log_t / shape)
+    value = x.size * log_scale + (1 + 1 / shape) * log_t.sum() + y.sum()
+    d = (y - shape - 1) / t
+    grad = np.array([d.sum() / scale,
+                     x.size + (z * d).sum(),
+                     ((y - 1) * log_t).sum() / shape ** 2 -
+                     (z * d).sum() / shape])
+    return value, grad
+
+
+def start(x):
+    """ Initial parameters from the moments of a Gumbel distribution. """
+    x = np.asarray(x, dtype=float)
+    scale = max(np.sqrt(6) * x.std() / np.pi, 1e-3)
+    location = x.mean() - EULER_GAMMA * scale
+    shape = 0.1
+    # Start within the support.
+    if 1 + shape * (x.min() - location) / scale <= 0:
+        shape = SHAPE_EPS
+    return location, scale, shape
+
+
+def fit(x, initial=None):
+    """
+    Estimate GEV parameters of values by maximum likelihood. Return
+    (location, scale, shape). Raise ValueError if the fit fails.
+        "initial": (location, scale, shape) the optimizer starts from,
+                   start(x) by default.
+    """
+    x = np.asarray(x, dtype=float)
+    assert x.size > 2, 'Not enough values to fit: %d.' % x.size
+    location, scale, shape = initial if initial else start(x)
+    if not np.isfinite(_nll(np.array([location, np.log(scale), shape]),
+                            x)[0]):
+        location, scale, shape = start(x)
+    # Standardize values, so that all parameters are of similar magnitude.
+    z = (x - location) / scale
+    result = minimize(_nll, np.array([0.0, 0.0, shape]), args=(z,),
+                      jac=True, method='BFGS',
+                      options={'maxiter': MAX_ITER, 'gtol': GTOL * x.size})
+    # Precision loss is only acceptable close to the optimum.
+    if not np.all(np.isfinite(result.x)) or not \
+            (result.success or
+             np.abs(result.jac).max() < 10 * GTOL * x.size):
+        raise ValueError('GEV fit did not converge: %s' % result.message)
+    z_location, z_log_scale, shape = result.x
+    return (float(location + z_location * scale),
+            float(scale * np.exp(z_log_scale)), float(shape))
+
+
+def cdf(q, location, scale, shape):
+    """
+    Probability that a value is less than or equal to q, vectorised over q.
+    """
+    q = np.asarray(q, dtype=float)
+    t = 1 + _shape(shape) * (q - location) / scale
+    with np.errstate(divide='ignore', over='ignore'):
+        p = np.exp(-np.where(t > 0, t, np.nan) ** (-1 / _shape(shape)))
+    # Below the support of positive shapes, above it for negative ones.
+    return np.where(t > 0, p, 0.0 if shape > 0 else 1.0)
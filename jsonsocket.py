@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Serve requests on a local Unix socket. Requests and responses are JSON
+objects, one per line.
+"""
+
+# Author: Robert Annessi <robert.annessi@nt.tuwien.ac.at>
+# License: GPLv2 (2016)
+
+
+import sys
+from json import loads, dumps
+from os import remove, lstat
+from os.path import lexists
+from stat import S_ISSOCK
+from errno import EADDRINUSE, ECONNREFUSED
+from socket import socket, error as socket_error, AF_UNIX, SOCK_STREAM
+from threading import Thread
+from SocketServer import ThreadingUnixStreamServer, StreamRequestHandler
+
+
+class _RequestHandler(StreamRequestHandler):
+    """ Answer each request line of a connection with a response line. """
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            try:
+                response = self.server.handler(loads(line))
+            except Exception, error:
+                response = {'error': str(error)}
+            self.wfile.write(dumps(response) + '\n')
+            self.wfile.flush()
+
+
+def _remove_stale(path):
+    """
+    Remove a socket that a server which is gone left behind at path. Raise
+    socket.error if path is anything else or a server still listens on it.
+    """
+    if not lexists(path):
+        return
+    if not S_ISSOCK(lstat(path).st_mode):
+        raise socket_error(EADDRINUSE, "'%s' is not a socket." % path)
+    client = socket(AF_UNIX, SOCK_STREAM)
+    try:
+        client.connect(path)
+    except socket_error, error:
+        if error.errno != ECONNREFUSED:
+            raise
+        remove(path)
+    else:
+        raise socket_error(EADDRINUSE, "'%s' is in use." % path)
+    finally:
+        client.close()
+
+
+class JSONServer(ThreadingUnixStreamServer):
+    """
+    Serve requests in a background thread.
+        "path": file system path of the Unix socket.
+        "handler": function that takes a request and returns the response.
+    """
+    daemon_threads = True
+
+    def __init__(self, path, handler):
+        _remove_stale(path)
+        ThreadingUnixStreamServer.__init__(self, path, _RequestHandler)
+        self.handler = handler
+        self._path = path
+        thread = Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        sys.stderr.write("Listening on '%s'.\n" % path)
+
+    def close(self):
+        """ Stop serving and remove socket. """
+        self.shutdown()
+        self.server_close()
+        remove(self._path)
@@ -1,37 +1,109 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-""" Merge and sort truncated measurement data files. """
+"""
+Merge and sort truncated measurement data files. Files are sorted in chunks
+spilled to temporary files, which are merged with the already sorted parts
+of the input files, so that memory use is bounded by the chunk size.
+"""
 
 # Author: Robert Annessi <robert.annessi@nt.tuwien.ac.at>
-# License: GPLv2 (2014-2015)
+# License: GPLv2 (2014-2016)
 
 
 import sys
 from cPickle import load, dump, HIGHEST_PROTOCOL
+from argparse import ArgumentParser
+from tempfile import TemporaryFile
+from heapq import merge
 
 from truncatedata import Probedata
+from testdata import pickles
 
 
-if not len(sys.argv) > 1:
-    print "Usage: %s truncprobefile1 [truncprobefile2 .. truncprobefileN]" % \
-          sys.argv[0]
-    sys.exit(1)
-
-
-probes = []
-for i in sys.argv:
-    if i == sys.argv[0]:
-        continue
-    with open(i, 'r') as f:
+def _sorted_prefix(f):
+    """
+    Return offset of the first probe that is out of order, None if all
+    probes are sorted.
+    """
+    previous = None
+    while True:
+        offset = f.tell()
         try:
-            while True:
-                probes.append(load(f))
+            probe = load(f)
         except EOFError:
-            pass
+            return None
+        if previous is not None and probe < previous:
+            return offset
+        previous = probe
+
+
+def _spill(probes):
+    """ Sort probes into a temporary file and return it. """
+    probes.sort()
+    spill = TemporaryFile(prefix='merge_')
+    for probe in probes:
+        dump(probe, spill, HIGHEST_PROTOCOL)
+    spill.seek(0)
+    return spill
+
+
+def _runs(path, chunk):
+    """
+    Split file into sorted runs. The sorted beginning of the file is read in
+    place and the rest is sorted in chunks of the given number of probes.
+    Return the runs and their open files.
+    """
+    f = open(path, 'rb')
+    unsorted = _sorted_prefix(f)
+    f.seek(0)
+    runs = [pickles(f, unsorted)]
+    files = [f]
+    if unsorted is not None:
+        rest = open(path, 'rb')
+        rest.seek(unsorted)
+        probes = []
+        for probe in pickles(rest):
+            probes.append(probe)
+            if len(probes) == chunk:
+                files.append(_spill(probes))
+                runs.append(pickles(files[-1]))
+                probes = []
+        if probes:
+            files.append(_spill(probes))
+            runs.append(pickles(files[-1]))
+        rest.close()
+    sys.stderr.write('%s: %s, %d sorted runs.\n'
+                     % (path, 'unsorted' if unsorted is not None
+                        else 'sorted', len(runs)))
+    return runs, files
+
+
+def _main():
+    """ Merge the sorted runs of all files to stdout. """
+    parser = ArgumentParser(description="Merge and sort truncated "
+                                        "measurement data files.")
+    parser.add_argument("files", nargs='+',
+                        help="Files of truncated measurement data.")
+    parser.add_argument("--chunk", type=int, default=500000,
+                        help="Maximum number of probes sorted in memory.")
+    args = parser.parse_args()
+    assert args.chunk > 0, 'Invalid chunk size.'
+
+    runs = []
+    files = []
+    try:
+        for path in args.files:
+            file_runs, file_files = _runs(path, args.chunk)
+            runs.extend(file_runs)
+            files.extend(file_files)
+        # sort by date
+        for probe in merge(*runs):
+            dump(probe, sys.stdout, HIGHEST_PROTOCOL)
+    finally:
+        for f in files:
+            f.close()
 
-# sort by date
-probes.sort()
 
-for probe in probes:
-    dump(probe, sys.stdout, HIGHEST_PROTOCOL)
+if __name__ == '__main__':
+    _main()
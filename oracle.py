@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Keep rolling statistics of live NavigaTor measurements for each relay and
+path, and predict the fastest paths from them.
+"""
+
+# Author: Robert Annessi <robert.annessi@nt.tuwien.ac.at>
+# License: GPLv2 (2016)
+
+
+from threading import Lock
+from collections import deque, OrderedDict
+from bisect import bisect_left, insort
+from heapq import heappush, heappop
+
+
+# Number of measurements the statistics of a relay or path roll over.
+WINDOW = 100
+# Maximum number of paths whose statistics are kept.
+MAX_PATHS = 100000
+
+METRICS = ('rtt', 'cbt', 'ttfb')
+POSITIONS = ('entry', 'middle', 'exit')
+
+
+class _Rolling(object):
+    """ Mean of the last "window" values, updated in O(1). """
+    __slots__ = ('_values', '_sum')
+
+    def __init__(self, window):
+        self._values = deque(maxlen=window)
+        self._sum = 0.0
+
+    def __len__(self):
+        return len(self._values)
+
+    def add(self, value):
+        """ Add value and drop the oldest one if the window is full. """
+        if len(self._values) == self._values.maxlen:
+            self._sum -= self._values[0]
+        self._values.append(value)
+        self._sum += value
+
+    def mean(self):
+        """ Mean of the values in the window, None if there are none. """
+        if not self._values:
+            return None
+        return self._sum / len(self._values)
+
+
+class _Relay(object):
+    """ Statistics and properties of a relay. """
+    __slots__ = ('stats', 'guard', 'exit_policy')
+
+    def __init__(self, window):
+        self.stats = dict((metric, _Rolling(window)) for metric in METRICS)
+        self.guard = False
+        self.exit_policy = None
+
+    def positions(self):
+        """ Path positions the relay may be used in. """
+        positions = ['middle']
+        if self.guard:
+            positions.append('entry')
+        if self.exit_policy and self.exit_policy.is_exiting_allowed():
+            positions.append('exit')
+        return positions
+
+
+class _Candidates(object):
+    """ Items of a sorted index that pass a filter, evaluated lazily. """
+    def __init__(self, index, accept):
+        self._index = index
+        self._accept = accept
+        self._next = 0
+        self._items = []
+
+    def get(self, i):
+        """ Return the i-th accepted (score, fingerprint), None if none. """
+        while len(self._items) <= i and self._next < len(self._index):
+            item = self._index[self._next]
+            self._next += 1
+            if self._accept(item[1]):
+                self._items.append(item)
+        if i < len(self._items):
+            return self._items[i]
+        return None
+
+
+class Oracle(object):
+    """
+    Rolling per-relay and per-path statistics of RTT, CBT and TTFB in ms.
+    For each metric and path position, relays are kept sorted by their mean,
+    so that queries only walk the head of these indexes.
+        "window": number of measurements the statistics roll over.
+    """
+    def __init__(self, window=WINDOW):
+        self._window = window
+        self._lock = Lock()
+        self._relays = dict()
+        self._paths = OrderedDict()
+        self._index = dict(((metric, position), [])
+                           for metric in METRICS for position in POSITIONS)
+
+    def update(self, relays, values):
+        """
+        Add the measurements of a circuit.
+            "relays": (fingerprint, is_guard, exit_policy) of entry, middle
+                      and exit relay.
+            "values": measurement of the circuit in ms by metric, None if
+                      missing.
+        """
+        with self._lock:
+            for fingerprint, guard, exit_policy in relays:
+                relay = self._relays.get(fingerprint)
+                if relay is None:
+                    relay = self._relays[fingerprint] = _Relay(self._window)
+                old_positions = relay.positions()
+                relay.guard = guard
+                relay.exit_policy = exit_policy
+                for metric in METRICS:
+                    old = relay.stats[metric].mean()
+                    if values.get(metric) is not None:
+                        relay.stats[metric].add(values[metric])
+                    self._reindex(metric, fingerprint, old, old_positions,
+                                  relay.stats[metric].mean(),
+                                  relay.positions())
+
+            path = tuple(fingerprint for fingerprint, _, _ in relays)
+            stats = self._paths.pop(path, None)
+            if stats is None:
+                stats = dict((metric, _Rolling(self._window))
+                             for metric in METRICS)
+                if len(self._paths) >= MAX_PATHS:
+                    self._paths.popitem(last=False)
+            self._paths[path] = stats
+            for metric in METRICS:
+                if values.get(metric) is not None:
+                    stats[metric].add(values[metric])
+
+    def _reindex(self, metric, fingerprint, old, old_positions, new,
+                 new_positions):
+        """ Move relay to its new place in the indexes of metric. """
+        if old is not None:
+            for position in old_positions:
+                index = self._index[(metric, position)]
+                i = bisect_left(index, (old, fingerprint))
+                if i < len(index) and index[i] == (old, fingerprint):
+                    del index[i]
+        if new is not None:
+            for position in new_positions:
+                insort(self._index[(metric, position)], (new, fingerprint))
+
+    def query(self, request):
+        """
+        Return the top-k predicted fastest paths. A path's prediction is the
+        mean of its relays' means. The request may contain:
+            "k": number of paths (default 10).
+            "metric": one of METRICS (default 'rtt').
+            "exclude": fingerprints of relays that must not be used.
+            "port": port the exit relay must allow exiting to.
+        """
+        k = int(request.get('k', 10))
+        metric = request.get('metric', 'rtt')
+        assert metric in METRICS, 'Unknown metric: %s.' % metric
+        exclude = set(request.get('exclude', ()))
+        port = request.get('port')
+
+        def usable(fingerprint):
+            """ Check that relay is not excluded. """
+            return fingerprint not in exclude
+
+        def exiting(fingerprint):
+            """ Check that relay is not excluded and exits to port. """
+            if fingerprint in exclude:
+                return False
+            return port is None or \
+                self._relays[fingerprint].exit_policy.can_exit_to(port=port)
+
+        paths = []
+        with self._lock:
+            candidates = [
+                _Candidates(self._index[(metric, 'entry')], usable),
+                _Candidates(self._index[(metric, 'middle')], usable),
+                _Candidates(self._index[(metric, 'exit')], exiting)]
+            # Best-first search over the sorted candidates.
+            heap = []
+            seen = set()
+
+            def push(pos):
+                """ Queue combination of candidate positions. """
+                if pos in seen:
+                    return
+                seen.add(pos)
+                items = [candidates[i].get(pos[i]) for i in range(3)]
+                if None not in items:
+                    heappush(heap, (sum(item[0] for item in items), pos,
+                                    items))
+
+            push((0, 0, 0))
+            while heap and len(paths) < k:
+                total, pos, items = heappop(heap)
+                fingerprints = tuple(item[1] for item in items)
+                if len(set(fingerprints)) == 3:
+                    stats = self._paths.get(fingerprints)
+                    observed = stats[metric].mean() if stats else None
+                    paths.append({'entry': fingerprints[0],
+                                  'middle': fingerprints[1],
+                                  'exit': fingerprints[2],
+                                  'predicted': total / 3,
+                                  'observed': observed})
+                for i in range(3):
+                    push(pos[:i] + (pos[i] + 1,) + pos[i + 1:])
+        return {'paths': paths}
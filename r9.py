@@ -7,202 +7,662 @@
 # License: GPLv2 (2014-2016)
 
 import sys
-from multiprocessing import Manager, Pool
-from collections import namedtuple
-from cPickle import load, dump, HIGHEST_PROTOCOL
+from multiprocessing import Manager, Pool, cpu_count
+from multiprocessing.sharedctypes import RawArray
+from threading import Semaphore
+from collections import namedtuple, deque
+from cPickle import dump, HIGHEST_PROTOCOL
 from gc import collect
 from argparse import ArgumentParser
 from os.path import exists
 from Queue import Empty
+from time import time
 import traceback
 
-from rpy2.robjects import r
-from rpy2.robjects.packages import importr
-from rpy2.robjects.vectors import DataFrame, IntVector
+import numpy as np
 
+import gev
 from cat import Probedata
+from testdata import WORKER, init_worker, pickles
 
+# rttps, ttfbps and bwps are the quantiles of all samples of RTTs, TTFBs and
+# throughputs, None for failed measurements.
 Probestat = namedtuple('Probestat',
-                       'date entry middle exit cbt cbtp cbtb rtts rttp rttb ttfbs bws cong congp congb')
+                       'date entry middle exit cbt cbtp cbtb rtts rttp rttb '
+                       'ttfbs bws cong congp congb rttps ttfbps bwps')
+# Probes generated before all samples were scored lack them.
+Probestat.__new__.__defaults__ = (None, None, None)
+
+# Number of values the distributions are fitted to.
+WINDOW = 1000
+# Measurements with a fitted distribution. The window of each holds one
+# value per probe, see _values().
+METRICS = ('cbt', 'rtt', 'cong', 'ttfb', 'bw')
 
 
 def _convert_to_dataframe(x):
-    """ Convert Python list of integers to R data frame. """
+    """ Convert list or array of integers to R data frame. """
+    from rpy2.robjects.vectors import DataFrame, IntVector
     tmp = dict()
-    tmp['y'] = IntVector(x)
+    tmp['y'] = IntVector([int(val) for val in x])
     return DataFrame(tmp)
 
 
-def _get_data_from_backup(vgam, queue, wlock):
-    try:
-        with wlock:
-            assert queue.qsize() in range(0, 2), 'Wrong size of queue!'
+def _fit_vgam(data):
+    """ Estimate GEV parameters with R's VGAM. """
+    from rpy2.robjects.packages import importr
+    vgam = importr('VGAM')
+    fit = vgam.vglm("y ~ 1", vgam.egev, _convert_to_dataframe(data))
+    location, scale, shape = vgam.Coef(fit)
+    return location, scale, shape
+
+
+def _cdf_vgam(val, location, scale, shape):
+    """
+    Evaluate GEV distribution function with R's VGAM, for each value if val
+    is a list.
+    """
+    from rpy2.robjects.packages import importr
+    from rpy2.robjects.vectors import FloatVector
+    vgam = importr('VGAM')
+    if isinstance(val, list):
+        return list(vgam.pgev(q=FloatVector(val), location=location,
+                              scale=scale, shape=shape))
+    return vgam.pgev(q=val, location=location, scale=scale, shape=shape)[0]
+
+
+def _cleanup_vgam():
+    """ Remove VGAM and all objects from R's memory space. """
+    from rpy2.robjects import r
+    from rpy2.robjects.packages import importr
+    importr('base').detach("package:VGAM")
+    r.rm(list=r.ls(all_names=True))
+    r.gc()
+
+
+def _cdf_numpy(val, location, scale, shape):
+    """
+    Evaluate GEV distribution function with NumPy, for each value if val is
+    a list.
+    """
+    if isinstance(val, list):
+        return gev.cdf(val, location, scale, shape).tolist()
+    return float(gev.cdf(val, location, scale, shape))
+
+
+# Functions of each engine that estimate GEV parameters, evaluate the
+# distribution function, and clean up after a probe.
+ENGINES = {'numpy': (gev.fit, _cdf_numpy, None),
+           'vgam': (_fit_vgam, _cdf_vgam, _cleanup_vgam)}
+
+
+def _get_data_from_backup(queue, wlock):
+    """ Return the last window that was fitted successfully, None if none. """
+    with wlock:
+        assert queue.qsize() in range(0, 2), 'Wrong size of queue!'
+        try:
+            data = queue.get(block=False)
+        except Empty:
+            return None
+        queue.put(data, block=False)
+    return data
+
+
+def _set_backup(data, queue, wlock):
+    """ Replace the backup window by data. """
+    with wlock:
+        while True:
             try:
-                data = queue.get(block=False)
+                queue.get(block=False)
             except Empty:
-                return False
-            queue.put(data, block=False)
-        fdata = _convert_to_dataframe(data)
-        fit = vgam.vglm("y ~ 1", vgam.egev, fdata)
-        return fit
-    except:
-        sys.stderr.write(str(traceback.format_exc()))
+                break
+        queue.put(data, block=False)
 
 
-def _calc_quantile(val, data, queue, wlock):
+def _calc_quantile(val, data, queue, wlock, engine, params=None,
+                   fallback=None):
     """
-    Calculate quantile for a specific CBT/RTT value from list of CBTs/RTTs.
+    Calculate quantile for a specific CBT/RTT value from list of CBTs/RTTs,
+    or quantiles of a list of values at once. If the GEV parameters cannot
+    be estimated, or are invalid, the last window that was fitted
+    successfully is used as backup.
+        "queue": holds the backup window, None if there is none.
+        "params": GEV parameters of data if already estimated.
+        "fallback": quantiles returned instead of using the backup window.
     """
-    try:
-        vgam = importr('VGAM')
-        r_base = importr('base')
-        fdata = _convert_to_dataframe(data)
-        backup = False
-    except:
-        sys.stderr.write(str(traceback.format_exc()))
+    fit, cdf, _ = ENGINES[engine]
+    backup = False
     try:
         # Estimate GEV parameters.
-        fit = vgam.vglm("y ~ 1", vgam.egev, fdata)
-    except:
+        if params is None:
+            params = fit(data)
+    except Exception:
         sys.stderr.write('Could not estimate parameters. Using backup..\n')
         backup = True
-    try:
-        if not backup:
-            with wlock:
-                while True:
-                    try:
-                        queue.get(block=False)
-                    except Empty:
-                        break
-                queue.put(data, block=False)
-    except:
-        sys.stderr.write(str(traceback.format_exc()))
 
-    try:
-        for _ in range(0, 2):
+    for _ in range(0, 2):
+        if backup and fallback is not None:
+            return (fallback, backup)
+        if backup and queue is None:
+            return (None, backup)
+        if backup:
+            data = _get_data_from_backup(queue, wlock)
+            if data is None:
+                return (None, backup)
+            try:
+                params = fit(data)
+            except Exception:
+                sys.stderr.write(str(traceback.format_exc()))
+                return (None, backup)
+
+        location, scale, shape = params
+        if not isinstance(shape, float) or not shape > 0 or \
+                not shape < float('inf'):
+            if backup:
+                return (None, backup)
+            backup = True
+            continue
+        if not backup and fallback is None and queue is not None:
+            _set_backup(data, queue, wlock)
+
+        # Calculate probability that the CBT/RTT with the given probability
+        # distribution will be found to be less than or equal to the
+        # probe's CBT/RTT value.
+        try:
+            prob = cdf(val, location, scale, shape)
+        except ValueError:
             if backup:
-                fit = _get_data_from_backup(vgam, queue, wlock)
-                if not fit:
-                    return (None, backup)
+                return (None, backup)
+            backup = True
+            continue
+        return (prob, backup)
 
-            location, scale, shape = vgam.Coef(fit)
+    assert False, 'We should never get here!'
+
+
+class _RankWindow(object):
+    """
+    Sliding window of the last WINDOW non-negative integers, e.g., ms, in a
+    Fenwick tree over their domain. Adding a value, dropping the oldest one
+    and ranking take O(log n) of the largest value.
+        "domain": initial number of distinct values, doubled as needed.
+    """
+    def __init__(self, domain=1 << 16):
+        self._tree = [0] * (domain + 1)
+        self._values = deque()
+
+    def __len__(self):
+        return len(self._values)
+
+    def _update(self, value, delta):
+        """ Change count of value by delta. """
+        i = value + 1
+        while i < len(self._tree):
+            self._tree[i] += delta
+            i += i & -i
+
+    def add(self, value):
+        """ Add value and drop the oldest one if the window is full. """
+        assert value >= 0, 'Negative value: %d.' % value
+        if value + 1 >= len(self._tree):
+            self._tree = [0] * (2 * max(value + 1, len(self._tree)) + 1)
+            for old in self._values:
+                self._update(old, 1)
+        self._update(value, 1)
+        self._values.append(value)
+        if len(self._values) > WINDOW:
+            self._update(self._values.popleft(), -1)
+
+    def rank(self, value):
+        """ Number of values in the window less than or equal to value. """
+        i = min(value + 1, len(self._tree) - 1)
+        rank = 0
+        while i > 0:
+            rank += self._tree[i]
+            i -= i & -i
+        return rank
+
+    def quantiles(self, values):
+        """ Empirical quantile of each value in the window. """
+        return [float(self.rank(value)) / len(self._values)
+                for value in values]
+
+
+def _empirical(probe, ranks):
+    """
+    Add values of probe to the rank windows, and return the empirical
+    quantiles of the probe's samples of each metric, None if there are no
+    samples or the window is not full yet.
+    """
+    quantiles = []
+    for rank, val, samples in zip(ranks, _values(probe), _samples(probe)):
+        if val is not None:
+            rank.add(val)
+        quantiles.append(rank.quantiles(samples)
+                         if samples and len(rank) >= WINDOW else None)
+    return quantiles
+
+
+class _WarmFit(object):
+    """
+    GEV parameters of a sliding window. Each fit starts from the parameters
+    of the previous one. In between, the parameters are reused while the
+    window has moved by less than "refit" values, unless the mean of the
+    window drifts by more than "drift" scales from its mean at the last
+    fit.
+    """
+    def __init__(self, refit=1, drift=None):
+        self._refit = refit
+        self._drift = drift
+        self._params = None
+        self._end = None
+        self._mean = None
+        self.fits = 0
+
+    def params(self, window, end):
+        """
+        Return GEV parameters of window, None if the fit fails.
+            "end": running number of the window's last value, which must
+                   not decrease between calls.
+        """
+        mean = float(np.mean(window))
+        if self._params is not None and end - self._end < self._refit and \
+                (self._drift is None or
+                 abs(mean - self._mean) <= self._drift * self._params[1]):
+            return self._params
+        try:
+            self._params = gev.fit(window, self._params)
+        except ValueError:
+            self._params = None
+            return None
+        self._end = end
+        self._mean = mean
+        self.fits += 1
+        return self._params
+
+
+class _SharedWindow(object):
+    """
+    Rolling window of values in a shared memory ring buffer, written by the
+    parent and read by workers. Values are addressed by their running
+    number, so a window is passed to workers as (start, end).
+        "size": capacity of the ring buffer, which must exceed the window by
+                the number of values appended while tasks are in flight.
+    """
+    def __init__(self, size):
+        self.values = RawArray('l', size)
+        self.end = 0
+
+    def append(self, value):
+        """ Add value, overwriting the oldest one if the buffer is full. """
+        self.values[self.end % len(self.values)] = value
+        self.end += 1
+
+    def window(self):
+        """ Return (start, end) of the last WINDOW values. """
+        return max(0, self.end - WINDOW), self.end
 
-            if not isinstance(shape, float) or not shape > 0 or not shape < float('inf'):
-                if backup:
-                    return (None, backup)
-                else:
-                    backup = True
-                    continue
 
-            # Calculate probability that the CBT/RTT with the given probability
-            # distribution will be found to be less than or equal to the
-            # probe's CBT/RTT value.
+def _read(values, start, end):
+    """
+    Return values of a ring buffer from running number start to end. The
+    values are not copied unless the window wraps around.
+    """
+    array = np.frombuffer(values, dtype=np.int_)
+    first = start % len(array)
+    if first + end - start <= len(array):
+        return array[first:first + end - start]
+    return np.concatenate((array[first:],
+                           array[:(first + end - start) % len(array)]))
+
+
+def _init_worker(rings, wlock, queues, engine, refit=None, drift=None):
+    """
+    Keep the shared state that all tasks of a worker use, see init_worker().
+    With refit, the worker warm-starts its fits of each of METRICS from its
+    previous ones, see _WarmFit.
+    """
+    fitters = None
+    if refit:
+        fitters = [_WarmFit(refit, drift) for _ in METRICS]
+    init_worker(dict(rings=rings, wlock=wlock, queues=queues, engine=engine,
+                     fitters=fitters))
+
+
+def _update_probe(task):
+    """
+    Generate probe including quantile values. Return None if that fails,
+    after reporting the error. A task consists of:
+        "probe": probe to generate statistics for.
+        "windows": (start, end) of the window of each of METRICS in the
+                   shared ring buffers.
+        "empirical": empirical quantiles of each of METRICS used if the
+                     GEV fit fails, None to use the backup windows.
+    """
+    probe, windows, empirical = task
+    engine = WORKER['engine']
+    wlock = WORKER['wlock']
+    fitters = WORKER['fitters']
+    try:
+        # Score all samples of a measurement with one evaluation.
+        quantiles = []
+        for i, samples in enumerate(_samples(probe)):
+            start, end = windows[i]
+            if not samples or end - start < WINDOW:
+                quantiles.append((None, False))
+                continue
+            # Empirical quantiles exist once the rank window is full too.
+            assert empirical is None or empirical[i] is not None, \
+                'Empirical quantiles of a full window are missing.'
+            data = _read(WORKER['rings'][i], start, end)
+            # Failed warm-started fits are repeated from scratch.
+            params = fitters[i].params(data, end) if fitters else None
+            quantiles.append(_calc_quantile(
+                samples, data, WORKER['queues'][i], wlock, engine,
+                params, empirical[i] if empirical else None))
+
+        cleanup = ENGINES[engine][2]
+        if cleanup:
             try:
-                prob = vgam.pgev(q=val, location=location, scale=scale, shape=shape)[0]
-            except ValueError:
-                if backup:
-                    return (None, backup)
-                else:
-                    backup = True
-                    continue
-            except:
+                cleanup()
+            except Exception:
                 sys.stderr.write(str(traceback.format_exc()))
 
-            # Remove VGAM from R's memory space.
-            r_base.detach("package:VGAM")
-            del vgam
-            return (prob, backup)
-    except:
+        return _probestat(probe, quantiles)
+    except Exception:
         sys.stderr.write(str(traceback.format_exc()))
+        return None
 
-    assert False, 'We should never get here!'
 
+def _probestat(probe, quantiles):
+    """
+    Generate probe including quantile values.
+        "quantiles": quantiles of the samples of each of METRICS, and
+                     whether the backup was used.
+    """
+    cbtp, rttps, congp, ttfbps, bwps = \
+        [_per_sample(measurements, probs) for measurements, (probs, _)
+         in zip((probe.cbt, probe.rtts, probe.cong, probe.perfs,
+                 probe.bws), quantiles)]
+    cbtbak, rttbak, congbak = [bak for _, bak in quantiles[:3]]
+    rttp = rttps[0] if rttps else None
+    return Probestat(date=probe.date, entry=probe.entry,
+                     middle=probe.middle, exit=probe.exit, cbt=probe.cbt,
+                     cbtp=cbtp, cbtb=cbtbak, rtts=probe.rtts,
+                     rttp=rttp, rttb=rttbak, ttfbs=probe.perfs,
+                     bws=probe.bws, cong=probe.cong, congp=congp,
+                     congb=congbak, rttps=rttps, ttfbps=ttfbps,
+                     bwps=bwps)
 
-def _update_probe(probe, cbts, rtts, congs, wlock, cqueue, rqueue, oqueue, ofile):
-    """ Generate probe including quantile values. """
-    try:
-        cbtp = None
-        cbtbak = False
-        rttp = None
-        rttbak = False
-        congp = None
-        congbak = False
-        if probe.cbt and len(cbts) >= 1000:
-            cbtp, cbtbak = _calc_quantile(probe.cbt, cbts, cqueue, wlock)
-        if len(probe.rtts) > 0 and isinstance(probe.rtts[0], int) and len(rtts) >= 1000:
-            rttp, rttbak = _calc_quantile(probe.rtts[0], rtts, rqueue, wlock)
-        if probe.cong and len(congs) >= 1000:
-            congp, congbak = _calc_quantile(probe.cong, congs, oqueue, wlock)
-
-        # We have to explicitely clean up R's memory space.
-        r.rm(list=r.ls(all_names=True))
-        r.gc()
-
-        data = Probestat(date=probe.date, entry=probe.entry,
-                         middle=probe.middle, exit=probe.exit, cbt=probe.cbt,
-                         cbtp=cbtp, cbtb=cbtbak, rtts=probe.rtts, rttp=rttp,
-                         rttb=rttbak, ttfbs=probe.perfs, bws=probe.bws,
-                         cong=probe.cong, congp=congp, congb=congbak)
-
-        with wlock:
-            with open(ofile, 'a') as f:
-                dump(data, f, HIGHEST_PROTOCOL)
-    except:
-        sys.stderr.write(str(traceback.format_exc()))
+
+def _tasks(probes, rings, slots, ranks):
+    """
+    Add values of probes to the shared windows and generate the tasks of
+    the probes. Each task takes one of the slots, which bounds the number
+    of tasks in flight. Empirical quantiles are added to tasks if there
+    are rank windows.
+    """
+    for probe in probes:
+        empirical = _empirical(probe, ranks) if ranks else None
+        windows = []
+        for i, val in enumerate(_values(probe)):
+            if val is not None:
+                rings[i].append(val)
+            windows.append(rings[i].window())
+        slots.acquire()
+        yield probe, windows, empirical
+
+
+def _probes(path):
+    """ Iterate through probes of file. """
+    with open(path, 'rb') as f:
+        for probe in pickles(f):
+            yield probe
+
+
+def _first(measurements):
+    """ Return first measurement if it did not fail, None otherwise. """
+    if measurements and isinstance(measurements[0], int):
+        return measurements[0]
+    return None
+
+
+def _values(probe):
+    """
+    Return the probe's CBT, first RTT, congestion, first TTFB and first
+    throughput, None if missing.
+    """
+    return (probe.cbt or None, _first(probe.rtts), probe.cong or None,
+            _first(probe.perfs), _first(probe.bws))
+
+
+def _samples(probe):
+    """
+    Return the probe's values of each metric that are scored: CBT,
+    congestion and all RTTs, TTFBs and throughputs that did not fail.
+    """
+    def ints(measurements):
+        """ Measurements that did not fail. """
+        return [val for val in measurements or () if isinstance(val, int)]
+
+    return ([probe.cbt] if probe.cbt else [], ints(probe.rtts),
+            [probe.cong] if probe.cong else [], ints(probe.perfs),
+            ints(probe.bws))
+
+
+def _per_sample(measurements, probs):
+    """
+    Assign quantiles to the measurements that did not fail. Return the
+    single quantile for a scalar measurement, None if there are none.
+    """
+    if probs is None:
+        return None
+    if not isinstance(measurements, list):
+        return probs[0]
+    probs = iter(probs)
+    return [next(probs) if isinstance(val, int) else None
+            for val in measurements]
+
+
+def _compare(path, every):
+    """
+    Fit every given window of the input with all engines, and report their
+    speed and the differences of their parameters and quantiles.
+    """
+    windows = [[] for _ in METRICS]
+    durations = dict((engine, 0.0) for engine in ENGINES)
+    errors = [0.0] * 4
+    fits = 0
+    windows_fitted = 0
+    failed = dict((engine, 0) for engine in ENGINES)
+    num = 0
+    for probe in _probes(path):
+        for window, val in zip(windows, _values(probe)):
+            if val is None:
+                continue
+            window.append(val)
+            if len(window) > WINDOW:
+                del window[0]
+            num += 1
+            if len(window) < WINDOW or num % every:
+                continue
+            windows_fitted += 1
+            results = dict()
+            for engine, (fit, cdf, cleanup) in ENGINES.iteritems():
+                start = time()
+                try:
+                    params = fit(window)
+                    results[engine] = list(params) + [cdf(val, *params)]
+                    if cleanup:
+                        cleanup()
+                except Exception:
+                    failed[engine] += 1
+                durations[engine] += time() - start
+            if len(results) < len(ENGINES):
+                continue
+            fits += 1
+            for i in range(4):
+                errors[i] = max(errors[i], abs(results['numpy'][i] -
+                                               results['vgam'][i]))
+    for engine in sorted(ENGINES):
+        sys.stderr.write('%s: %.2f ms per fit, %d failed.\n'
+                         % (engine, durations[engine] * 1000 /
+                            max(windows_fitted, 1), failed[engine]))
+    sys.stderr.write('Maximum differences of %d fits: location %g, scale %g, '
+                     'shape %g, quantile %g.\n' % tuple([fits] + errors))
+
+
+def _compare_warm(path, every, refit, drift):
+    """
+    Fit all windows of the input with warm-started fits, and every given
+    window also from scratch. Report their speed and the maximum difference
+    of the quantiles.
+    """
+    windows = [[] for _ in METRICS]
+    fitters = [_WarmFit(refit, drift) for _ in windows]
+    ends = [0] * len(windows)
+    warm = 0.0
+    full = 0.0
+    fulls = 0
+    errors = []
+    num = 0
+    for probe in _probes(path):
+        for i, val in enumerate(_values(probe)):
+            if val is None:
+                continue
+            window = windows[i]
+            window.append(val)
+            ends[i] += 1
+            if len(window) > WINDOW:
+                del window[0]
+            if len(window) < WINDOW:
+                continue
+            num += 1
+            start = time()
+            params = fitters[i].params(window, ends[i])
+            warm += time() - start
+            if num % every or params is None:
+                continue
+            start = time()
+            try:
+                exact = gev.fit(window)
+            except ValueError:
+                continue
+            full += time() - start
+            fulls += 1
+            errors.append(abs(_cdf_numpy(val, *params) -
+                              _cdf_numpy(val, *exact)))
+    fits = sum(fitter.fits for fitter in fitters)
+    sys.stderr.write('Warm-started: %.3f ms per window, %d fits for %d '
+                     'windows.\n' % (warm * 1000 / max(num, 1), fits, num))
+    sys.stderr.write('From scratch: %.3f ms per window.\n'
+                     % (full * 1000 / max(fulls, 1)))
+    sys.stderr.write('Quantile error of %d windows: maximum %g, mean %g.\n'
+                     % (len(errors), max(errors or [0]),
+                        sum(errors) / max(len(errors), 1)))
 
 
 def _main():
-    """ Add statistical information to all probes' CBTs and RTTs. """
-    rtts = []
-    cbts = []
-    congs = []
-    manager = Manager()
-    wlock = manager.Lock()
-    cqueue = manager.Queue()
-    rqueue = manager.Queue()
-    oqueue = manager.Queue()
-    pool = Pool()
+    """
+    Add statistical information to all probes' CBTs and RTTs. Probes are
+    scored in parallel against windows in shared memory, and written in
+    input order.
+    """
     parser = ArgumentParser(description="Add statistical information" +
                                         "to probes")
     parser.add_argument("--input", type=str, required=True, help="Input file.")
-    parser.add_argument("--output", type=str, required=True,
+    parser.add_argument("--output", type=str,
                         help="Output file.")
+    parser.add_argument("--engine", choices=sorted(ENGINES),
+                        default='numpy',
+                        help="Implementation of GEV fits (default: numpy).")
+    parser.add_argument("--compare", type=int, metavar='EVERY',
+                        help="Instead of adding statistics, compare engines "
+                        "on every EVERY-th window of the input. With "
+                        "--refit, compare warm-started with full fits.")
+    parser.add_argument("--refit", type=int, metavar='K',
+                        help="Warm-start fits from the previous window's "
+                        "parameters, and reuse them for up to K probes.")
+    parser.add_argument("--mode", choices=('gev', 'empirical'),
+                        default='gev',
+                        help="Quantiles of fitted GEV distributions, or "
+                        "empirical quantiles of the windows (default: gev).")
+    parser.add_argument("--fallback", choices=('backup', 'empirical'),
+                        default='backup',
+                        help="If a GEV fit fails, use the last window that "
+                        "was fitted successfully, or empirical quantiles "
+                        "(default: backup).")
+    parser.add_argument("--drift", type=float,
+                        help="With --refit, fit earlier if the window mean "
+                        "drifts by more than this many scales.")
     args = parser.parse_args()
+    if args.drift is not None and not args.refit:
+        parser.error('--drift requires --refit.')
     assert args.input and exists(args.input), 'Invalid input file.'
+    assert args.refit is None or args.refit > 0, 'Invalid refit interval.'
+    assert args.refit is None or args.engine == 'numpy', \
+        'Warm-started fits need the numpy engine.'
+    if args.compare and args.refit:
+        _compare_warm(args.input, args.compare, args.refit, args.drift)
+        return
+    if args.compare:
+        _compare(args.input, args.compare)
+        return
     assert args.output and not exists(args.output), 'Invalid output file.'
+    if args.mode == 'empirical':
+        ranks = [_RankWindow() for _ in METRICS]
+        with open(args.output, 'w') as f:
+            for probe in _probes(args.input):
+                quantiles = [(probs, False)
+                             for probs in _empirical(probe, ranks)]
+                dump(_probestat(probe, quantiles), f, HIGHEST_PROTOCOL)
+        return
+    ranks = None
+    wlock = None
+    queues = [None] * len(METRICS)
+    if args.fallback == 'empirical':
+        ranks = [_RankWindow() for _ in METRICS]
+    else:
+        manager = Manager()
+        wlock = manager.Lock()
+        queues = [manager.Queue() for _ in METRICS]
+    try:
+        cpus = cpu_count()
+    except NotImplementedError:
+        cpus = 1
+    slots = Semaphore(4 * cpus)
+    rings = [_SharedWindow(WINDOW + 8 * cpus) for _ in queues]
+    pool = Pool(cpus, _init_worker, ([ring.values for ring in rings], wlock,
+                                     queues, args.engine, args.refit,
+                                     args.drift))
 
-    with open(args.input, 'r') as f:
-        try:
-            while True:
-                try:
-                    probe = load(f)
-                except EOFError:
-                    break
-                if probe.cbt:
-                    cbts.append(probe.cbt)
-                if len(probe.rtts) > 0 and isinstance(probe.rtts[0], int):
-                    rtts.append(probe.rtts[0])
-                if probe.cong:
-                    congs.append(probe.cong)
-                pool.apply_async(_update_probe, (probe, cbts, rtts,
-                                                 congs, wlock, cqueue,
-                                                 rqueue, oqueue, args.output))
-                if len(cbts) > 1000:
-                    del cbts[0]
-                if len(rtts) > 1000:
-                    del rtts[0]
-                if len(congs) > 1000:
-                    del congs[0]
+    dropped = 0
+    try:
+        with open(args.output, 'w') as f:
+            for data in pool.imap(_update_probe,
+                                  _tasks(_probes(args.input), rings, slots,
+                                         ranks)):
+                slots.release()
+                if data:
+                    dump(data, f, HIGHEST_PROTOCOL)
+                else:
+                    dropped += 1
                 # Run garbage collector after cleaning R's memory space.
-                collect()
-        except KeyboardInterrupt:
-            pass
-        except:
-            sys.stderr.write(str(traceback.format_exc()))
-    pool.close()
+                if args.engine == 'vgam':
+                    collect()
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+    except Exception:
+        sys.stderr.write(str(traceback.format_exc()))
+        pool.terminate()
     pool.join()
-    assert cqueue.qsize() in range(0, 2), 'Wrong size of queue!'
-    assert rqueue.qsize() in range(0, 2), 'Wrong size of queue!'
+    if dropped:
+        sys.stderr.write('Dropped %d probes that could not be scored.\n'
+                         % dropped)
+    for queue in queues:
+        assert queue is None or queue.qsize() in range(0, 2), \
+            'Wrong size of queue!'
 
 
 if __name__ == '__main__':
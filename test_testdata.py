@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Tests of testdata and truncatedata with stem's own classes. """
+
+# Author: Robert Annessi <robert.annessi@nt.tuwien.ac.at>
+# License: GPLv2 (2016)
+
+import unittest
+from cPickle import dumps, loads, HIGHEST_PROTOCOL
+from random import Random
+from StringIO import StringIO
+from tempfile import NamedTemporaryFile
+from threading import Semaphore
+import tarfile
+
+from lzo import compress
+from stem.response import ControlMessage
+from stem.descriptor.router_status_entry import RouterStatusEntryV3
+from stem.descriptor.server_descriptor import RelayDescriptor
+
+from NavigaTor import Probe, Node
+from testdata import loads_stubbed, synthetic_relays, synthetic_probe, \
+    _checkpath, _check_probe, _Report, _batches, _validate
+from truncatedata import _truncate
+
+
+def _event(line):
+    """ Parse an asynchronous event of tor's control protocol. """
+    return ControlMessage.from_str('650 %s\r\n' % line, 'EVENT')
+
+
+def _node(fingerprint, flags):
+    """
+    Return node whose descriptors are lazily loaded, as received from tor,
+    so that most of their attributes are only parsed on access.
+    """
+    content = RelayDescriptor.content((('fingerprint',
+                                        ' '.join([fingerprint] * 10)),))
+    # Allow exiting to port 80 before the default policy rejects all.
+    content = content.replace('reject *:*', 'accept *:80\nreject *:*')
+    desc = RelayDescriptor(content, validate=False)
+    ns = RouterStatusEntryV3(RouterStatusEntryV3.content({'s': flags}),
+                             validate=False)
+    return Node(desc=desc, ns=ns)
+
+
+def _probe():
+    """ Return a probe over a path of lazily loaded descriptors. """
+    path = [_node('AAAA', 'Guard Running Valid'),
+            _node('BBBB', 'Running Valid'),
+            _node('CCCC', 'Exit Running Valid')]
+    circ = _event('CIRC 1 BUILT $%s,$%s,$%s PURPOSE=GENERAL '
+                  'TIME_CREATED=2016-01-01T12:00:00.000000'
+                  % ('AAAA' * 10, 'BBBB' * 10, 'CCCC' * 10))
+    return Probe(path=path, circs=[circ], cbt=[], streams=[], perf=[],
+                 bw=[])
+
+
+class TestStubs(unittest.TestCase):
+    """ Unpickling probes with stubs of stem events. """
+
+    def setUp(self):
+        # Pickle before any lazily loaded attribute is accessed.
+        self.data = dumps(_probe(), HIGHEST_PROTOCOL)
+
+    def test_checkpath(self):
+        for unpickle in (loads, loads_stubbed):
+            self.assertTrue(_checkpath(unpickle(self.data).path))
+
+    def test_truncate(self):
+        cprobe = compress(self.data)
+        probedata = _truncate(cprobe, loads_stubbed)
+        self.assertEqual(probedata, _truncate(cprobe, loads))
+        self.assertEqual((probedata.entry, probedata.middle, probedata.exit),
+                         ('AAAA' * 10, 'BBBB' * 10, 'CCCC' * 10))
+
+
+class TestMeasurements(unittest.TestCase):
+    """ Probes with another number of measurements than earlier ones. """
+
+    def setUp(self):
+        rng = Random(0)
+        relays = synthetic_relays(3, rng)
+        self.probes = [synthetic_probe(num, relays, rng, num_rttprobes=3)[0]
+                       for num in range(3)]
+        # Drop the stream events of the last RTT probe of the second probe.
+        streams = self.probes[1].streams
+        self.probes[1] = self.probes[1]._replace(
+            streams=[stream for stream in streams
+                     if stream.id != streams[-1].id])
+
+    def test_mismatched(self):
+        report = _Report()
+        nr_measurements = None
+        classifications = []
+        for data in self.probes:
+            classification, classes, address, nr_measurements = \
+                _check_probe(data, nr_measurements)
+            report.count('archive')
+            report.add('archive', classification, classes, address)
+            classifications.append(classification)
+        self.assertEqual(classifications,
+                         ['Finished', 'Mismatched', 'Finished'])
+        self.assertEqual(nr_measurements, 3)
+        self.assertEqual(report.archives['archive']['mismatched'], 1)
+        self.assertTrue(report.failed())
+
+    def test_batches(self):
+        with NamedTemporaryFile(suffix='.tar') as archive:
+            tar = tarfile.open(fileobj=archive, mode='w')
+            for num, data in enumerate(self.probes):
+                data = compress(dumps(data, HIGHEST_PROTOCOL))
+                info = tarfile.TarInfo('Probe_%d.lzo' % num)
+                info.size = len(data)
+                tar.addfile(info, StringIO(data))
+            tar.close()
+            archive.flush()
+            results = []
+            for size in (1, 2, 3):
+                report = _Report()
+                for task in _batches([archive.name], False,
+                                     Semaphore(len(self.probes) + 1), size):
+                    report.merge(_validate(task))
+                results.append((report.circuits, report.archives,
+                                report.measurements))
+        self.assertEqual(results[0][0]['Mismatched'], 1)
+        self.assertEqual(results[0][2], {archive.name: 3})
+        self.assertEqual(results[1], results[0])
+        self.assertEqual(results[2], results[0])
+
+    def test_archives_differ(self):
+        report = _Report()
+        for archive, nr_measurements in (('a', 3), ('b', 2)):
+            other = _Report()
+            other.measurements[archive] = nr_measurements
+            report.merge(other)
+        self.assertFalse(report.failures)
+        self.assertTrue(report.failed())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -6,91 +6,183 @@
 # Author: Robert Annessi <robert.annessi@nt.tuwien.ac.at>
 # License: GPLv2 (2013-2015)
 
-from sys import stdin, stdout
-from cPickle import loads
+from sys import stdin, stdout, stderr, exc_info, modules, exit
+from cPickle import load, loads, Unpickler
+from cStringIO import StringIO
+from glob import glob
+from threading import Thread, Event, Semaphore
+from Queue import Queue, Empty
+from argparse import ArgumentParser
+from collections import Counter, OrderedDict
+from multiprocessing import cpu_count
+from multiprocessing.pool import Pool
+from re import sub
+from os.path import getsize
+from time import time
+from datetime import datetime, timedelta
+from calendar import timegm
+from base64 import b64encode
+from binascii import unhexlify
 import tarfile
 
 from lzo import decompress
+from stem.response import ControlMessage
 from stem.response.events import StreamEvent, CircuitEvent
 from stem.descriptor.router_status_entry import RouterStatusEntryV3
 from stem.descriptor.server_descriptor import RelayDescriptor
 
-from NavigaTor import Probe, Node
+from NavigaTor import Probe, Node, RTT_PORT
 
 
-def stream_from_good_probe(streams):
-    """ Check if list of streams represents a successful RTT-probe. """
+# Number of archive members read ahead of their processing.
+READAHEAD = 64
+# Number of archive members between progress reports.
+PROGRESS = 10000
+# Number of probes checked at once by a process.
+BATCH = 256
+
+
+class _Stub(object):
+    """
+    Lightweight replacement of a stem event class when unpickling. Only the
+    pickled attributes are restored, without any parsing. Events parse all
+    their attributes on creation, unlike descriptors, which create many of
+    them lazily on access and are therefore unpickled as they are.
+    """
+    def __setstate__(self, state):
+        if isinstance(state, tuple):
+            state, slots = state
+            if slots:
+                self.__dict__.update(slots)
+        if state:
+            self.__dict__.update(state)
+
+
+# Stubs of stem event classes by module and name.
+_STUBS = dict(((cls.__module__, cls.__name__),
+               type(cls.__name__, (_Stub,), {'__module__': cls.__module__}))
+              for cls in (StreamEvent, CircuitEvent))
+
+
+def _find_stub(module, name):
+    """ Return stub of stem class, or the class itself if it has none. """
+    stub = _STUBS.get((module, name))
+    if stub:
+        return stub
+    __import__(module)
+    return getattr(modules[module], name)
+
+
+def loads_stubbed(data):
+    """
+    Unpickle data like loads(), but with stem events replaced by stubs.
+    """
+    unpickler = Unpickler(StringIO(data))
+    unpickler.find_global = _find_stub
+    return unpickler.load()
+
+
+def _isinstance(obj, cls):
+    """ Check if obj is an instance of cls or of its stub. """
+    return isinstance(obj, cls) or \
+        type(obj) is _STUBS.get((cls.__module__, cls.__name__))
+
+
+# Stream event sequences of RTT-probes by classification. Each element lists
+# the alternative tokens of an event, see _token().
+_FAILED_REFUSED = [('FAILED', 'TORPROTOCOL'),
+                   ('FAILED', 'END', 'CONNECTREFUSED')]
+_CLOSED_REFUSED = [('CLOSED', 'TORPROTOCOL'),
+                   ('CLOSED', 'END', 'CONNECTREFUSED')]
+_DETACHED_TIMEOUT = [('DETACHED', 'TIMEOUT'),
+                     ('DETACHED', 'END', 'HIBERNATING'),
+                     ('DETACHED', 'END', 'MISC'),
+                     ('DETACHED', 'END', 'RESOURCELIMIT')]
+STREAM_PATTERNS = (
+    # Successful probe.
+    ('GOOD', ([('NEW', 'USER')], [('SENTCONNECT',)], _FAILED_REFUSED,
+              _CLOSED_REFUSED)),
+    # Circuit failed during probing.
+    ('TIMEOUT', ([('NEW', 'USER')], [('SENTCONNECT',)], _DETACHED_TIMEOUT,
+                 [('FAILED', 'TIMEOUT')], [('CLOSED', 'TIMEOUT')])),
+    # Circuit failed before probing.
+    ('BAD', ([('NEW', 'USER')], [('FAILED', 'MISC')], [('CLOSED', 'MISC')])),
+    # Circuit was unexpectedly closed.
+    ('BAD', ([('NEW', 'USER')], [('SENTCONNECT',)], [('FAILED', 'DESTROY')],
+             [('CLOSED', 'DESTROY')])))
+
+
+def _token(event):
+    """ Reduce a stream event to the fields its classification depends on. """
+    if event.status == 'NEW':
+        return (event.status, event.purpose)
+    if event.status == 'SENTCONNECT':
+        return (event.status,)
+    if event.reason == 'END':
+        return (event.status, event.reason, event.remote_reason)
+    return (event.status, event.reason)
+
+
+def _compile(patterns):
+    """
+    Compile patterns into a state table. Return the transitions of each
+    state by token, and the classification of accepting states.
+    """
+    transitions = [dict()]
+    accepting = dict()
+    for classification, pattern in patterns:
+        states = [0]
+        for alternatives in pattern:
+            following = set()
+            for state in states:
+                for token in alternatives:
+                    if token not in transitions[state]:
+                        transitions[state][token] = len(transitions)
+                        transitions.append(dict())
+                    following.add(transitions[state][token])
+            states = following
+        for state in states:
+            assert accepting.get(state, classification) == classification, \
+                'Ambiguous stream patterns.'
+            accepting[state] = classification
+    return transitions, accepting
+
+
+_TRANSITIONS, _ACCEPTING = _compile(STREAM_PATTERNS)
+
+
+def classify_stream(streams):
+    """
+    Classify list of stream events of an RTT-probe as 'GOOD', 'TIMEOUT' or
+    'BAD'. Return None if it matches none of them.
+    """
     # Input validation
     assert isinstance(streams, list), 'Input must be list.'
-    for i in range(0, len(streams)):
-        assert isinstance(streams[i], StreamEvent), \
+    state = 0
+    for stream in streams:
+        assert _isinstance(stream, StreamEvent), \
             'All list elements must be of type StreamEvent.'
-    if len(streams) != 4:
-        return False
-    # Check if probe was successful.
-    if streams[0].status == 'NEW' and streams[0].purpose == 'USER' and \
-       streams[1].status == 'SENTCONNECT' and \
-       streams[2].status == 'FAILED' and \
-       (streams[2].reason == 'TORPROTOCOL' or
-        (streams[2].reason == 'END' and
-         streams[2].remote_reason == 'CONNECTREFUSED')) and \
-       streams[3].status == 'CLOSED' and \
-       (streams[3].reason == 'TORPROTOCOL' or
-        (streams[3].reason == 'END' and
-         streams[3].remote_reason == 'CONNECTREFUSED')):
-        return True
-    else:
-        return False
+        state = _TRANSITIONS[state].get(_token(stream))
+        if state is None:
+            return None
+    return _ACCEPTING.get(state)
+
+
+def stream_from_good_probe(streams):
+    """ Check if list of streams represents a successful RTT-probe. """
+    return classify_stream(streams) == 'GOOD'
 
 
 def stream_from_timeout_probe(streams):
     """
     Check if list of streams represents a RTT-probe that timed out.
     """
-    # Input validation
-    assert (isinstance(streams, list)), 'Input must be list.'
-    for i in range(0, len(streams)):
-        assert isinstance(streams[i], StreamEvent), \
-            'All list elements must be of type StreamEvent.'
-    if len(streams) != 5:
-        return False
-    # Check if circuit failed during probing.
-    if streams[0].status == 'NEW' and streams[0].purpose == 'USER' and \
-       streams[1].status == 'SENTCONNECT' and \
-       streams[2].status == 'DETACHED' and \
-       (streams[2].reason == 'TIMEOUT' or
-        (streams[2].reason == 'END' and
-         (streams[2].remote_reason == 'HIBERNATING' or
-          streams[2].remote_reason == 'MISC' or
-          streams[2].remote_reason == 'RESOURCELIMIT'))) and \
-       streams[3].status == 'FAILED' and streams[3].reason == 'TIMEOUT' and \
-       streams[4].status == 'CLOSED' and streams[4].reason == 'TIMEOUT':
-        return True
-    return False
+    return classify_stream(streams) == 'TIMEOUT'
 
 
 def stream_from_bad_probe(streams):
     """ Check if list of streams represents an unsuccessful RTT-probe. """
-    # Input validation
-    assert (isinstance(streams, list)), 'Input must be list.'
-    for i in range(0, len(streams)):
-        assert isinstance(streams[i], StreamEvent), \
-            'All list elements must be of type StreamEvent.'
-    if len(streams) == 3:
-        # Check if circuit has failed before probing.
-        if streams[0].status == 'NEW' and streams[0].purpose == 'USER' and \
-           streams[1].status == 'FAILED' and streams[1].reason == 'MISC' and \
-           streams[2].status == 'CLOSED' and streams[2].reason == 'MISC':
-            return True
-    elif len(streams) == 4:
-        # Check if circuit was unexpectedly closed.
-        if streams[0].status == 'NEW' and streams[0].purpose == 'USER' and \
-           streams[1].status == 'SENTCONNECT' and \
-           streams[2].status == 'FAILED' and \
-           streams[2].reason == 'DESTROY' and \
-           streams[3].status == 'CLOSED' and streams[3].reason == 'DESTROY':
-            return True
-    return False
+    return classify_stream(streams) == 'BAD'
 
 
 def _built_circuit(circs):
@@ -101,7 +193,7 @@ def _built_circuit(circs):
     assert isinstance(circs, list), \
         'Circuit list has wrong type: %s.' % type(circs)
     for i in range(0, len(circs)):
-        assert isinstance(circs[i], CircuitEvent), \
+        assert _isinstance(circs[i], CircuitEvent), \
             'All list elements must be of type CircuitEvent.'
     # Check if circuit was successfully built.
     if ['LAUNCHED', 'EXTENDED', 'EXTENDED', 'EXTENDED', 'BUILT', 'CLOSED'] == \
@@ -124,7 +216,7 @@ def _valid_circuit(circs):
     assert isinstance(circs, list), \
         'Circuit list has wrong type: %s.' % type(circs)
     for i in range(0, len(circs)):
-        assert isinstance(circs[i], CircuitEvent), \
+        assert _isinstance(circs[i], CircuitEvent), \
             'All list elements must be of type CircuitEvent.'
     # check purpose
     for circ in circs:
@@ -141,9 +233,9 @@ def _checkpath(path_list):
         assert isinstance(node, Node), 'Node has wrong type: %s.' % type(node)
         assert node.ns, 'Node has no networkstatus.'
         assert node.desc, 'Node has no descriptor.'
-        assert isinstance(node.ns, RouterStatusEntryV3), \
+        assert _isinstance(node.ns, RouterStatusEntryV3), \
             'Wrong ns type: %s.' % type(node.ns)
-        assert isinstance(node.desc, RelayDescriptor), \
+        assert _isinstance(node.desc, RelayDescriptor), \
             'Wrong desc type: %s.' % type(node.desc)
         assert 'Running' in node.ns.flags, 'Node is not running.'
         assert 'Valid' in node.ns.flags, 'Node is not valid.'
@@ -165,31 +257,264 @@ def _good_path(path):
     return len(path) == 3
 
 
-def cprobes():
-    """ Iterate through compressed probes generated by NavigaTor. """
-    with tarfile.open(fileobj=stdin, mode="r|") as tar:
+# Date of the first synthetic probe, see synthetic_probe(). Synthetic
+# probes are built from stem's own classes, for benchmarks and tests.
+SYNTHETIC_START = datetime(2016, 1, 1)
+
+
+def _event(line, arrived_at=None):
+    """ Parse an asynchronous event of tor's control protocol. """
+    return ControlMessage.from_str('650 %s\r\n' % line, 'EVENT',
+                                   arrived_at=arrived_at)
+
+
+def synthetic_relays(num, rng):
+    """ Return num relays with lazily loaded descriptors. """
+    relays = []
+    for i in range(num):
+        fingerprint = '%040X' % rng.getrandbits(160)
+        content = RelayDescriptor.content(
+            (('fingerprint', ' '.join(fingerprint[j:j + 4]
+                                      for j in range(0, 40, 4))),))
+        flags = 'Fast Running Stable Valid'
+        if i % 3 == 0:
+            flags = 'Guard ' + flags
+        if i % 3 == 2:
+            flags = 'Exit ' + flags
+            content = content.replace('reject *:*', 'accept *:80\nreject *:*')
+        router = 'Unnamed %s oQZFLYe9e4A7bOkWKR7TaNxb0JE 2016-01-01 ' \
+            '00:00:00 10.0.%d.%d 9001 0' \
+            % (b64encode(unhexlify(fingerprint))[:27], i >> 8 & 255, i & 255)
+        ns = RouterStatusEntryV3.content((('r', router), ('s', flags)))
+        relays.append(Node(desc=RelayDescriptor(content, validate=False),
+                           ns=RouterStatusEntryV3(ns, validate=False)))
+    return relays
+
+
+def _streams(sid, port, dest, now, rng):
+    """
+    Return stream events of an RTT probe, mostly successful, some timed
+    out.
+    """
+    target = '%s:%d' % (dest, port)
+    events = [_event('STREAM %d NEW 0 %s SOURCE_ADDR=127.0.0.1:%d '
+                     'PURPOSE=USER' % (sid, target, 1024 + sid % 64000), now),
+              _event('STREAM %d SENTCONNECT 1 %s' % (sid, target), now)]
+    now += rng.uniform(0.05, 1.5)
+    if rng.random() < 0.95:
+        reason = 'REASON=END REMOTE_REASON=CONNECTREFUSED'
+        events += [_event('STREAM %d FAILED 1 %s %s' % (sid, target, reason),
+                          now),
+                   _event('STREAM %d CLOSED 1 %s %s' % (sid, target, reason),
+                          now)]
+    else:
+        events += [_event('STREAM %d DETACHED 1 %s REASON=TIMEOUT'
+                          % (sid, target), now),
+                   _event('STREAM %d FAILED 0 %s REASON=TIMEOUT'
+                          % (sid, target), now),
+                   _event('STREAM %d CLOSED 0 %s REASON=TIMEOUT'
+                          % (sid, target), now)]
+    return events
+
+
+def synthetic_probe(num, relays, rng, num_rttprobes=10):
+    """
+    Return the synthetic probe number num of a path of the given relays,
+    with its destination address.
+    """
+    path = [rng.choice(relays[0::3]), rng.choice(relays[1::3]),
+            rng.choice(relays[2::3])]
+    dest = '127.%d.%d.%d' % (num >> 16 & 255, num >> 8 & 255, num & 255)
+    created = SYNTHETIC_START + timedelta(seconds=num)
+    now = timegm(created.timetuple())
+    hops = ','.join('$%s~Unnamed' % node.desc.fingerprint for node in path)
+    stamp = 'PURPOSE=GENERAL TIME_CREATED=%s' % created.isoformat()
+    circs = [_event('CIRC %d LAUNCHED %s' % (num, stamp), now)]
+    for i in range(1, 4):
+        circs.append(_event('CIRC %d EXTENDED %s %s'
+                            % (num, ','.join(hops.split(',')[:i]), stamp),
+                            now))
+    circs.append(_event('CIRC %d BUILT %s %s' % (num, hops, stamp), now))
+    streams = []
+    for i in range(num_rttprobes):
+        streams.extend(_streams(num * num_rttprobes + i, RTT_PORT + i, dest,
+                                now, rng))
+    circs.append(_event('CIRC %d CLOSED %s %s REASON=REQUESTED'
+                        % (num, hops, stamp), now))
+    connect = rng.uniform(0.1, 1.0)
+    perf = [[connect, connect + rng.uniform(0.2, 2.0),
+             connect + rng.uniform(2.0, 3.0)]]
+    bw = [[connect, connect + rng.uniform(0.2, 2.0),
+           connect + rng.uniform(10.0, 60.0)]]
+    return Probe(path=path, circs=circs, cbt=set([rng.randint(200, 3000)]),
+                 streams=streams, perf=perf, bw=bw), dest
+
+
+# State of the processes of a pool, set by init_worker().
+WORKER = dict()
+
+
+def init_worker(state):
+    """ Keep state that all tasks of a pool process use, see WORKER. """
+    WORKER.update(state)
+
+
+def pickles(fileobj, end=None):
+    """
+    Iterate through the objects of a pickle stream, e.g., truncated data,
+    up to offset end.
+    """
+    while end is None or fileobj.tell() < end:
+        try:
+            yield load(fileobj)
+        except EOFError:
+            break
+
+
+def archives(patterns):
+    """
+    Expand paths and glob patterns of archives, keeping the given order.
+    Matches of a single pattern are sorted.
+    """
+    paths = []
+    for pattern in patterns:
+        matches = sorted(glob(pattern))
+        assert matches, 'No archive matches %s.' % pattern
+        paths.extend(matches)
+    return paths
+
+
+def _members(fileobj, prefix):
+    """ Iterate through members of a tar stream starting with prefix. """
+    with tarfile.open(fileobj=fileobj, mode="r|") as tar:
         while True:
-            cprobe = tar.next()
-            if not cprobe:
+            member = tar.next()
+            if not member:
                 raise StopIteration()
-            tarx = tar.extractfile(cprobe)
+            if not member.name.startswith(prefix):
+                continue
+            tarx = tar.extractfile(member)
             if not tarx:
                 continue
             yield tarx.read()
 
 
-def probes():
-    """ Iterate through uncompressed probes generated by NavigaTor. """
-    for cprobe in cprobes():
+def _read_ahead(items, size, decode=None):
+    """
+    Iterate through items that a thread fetches, and optionally decodes, up
+    to size items ahead. Errors of the thread are raised in the caller. If
+    the caller stops early, the thread stops after its current item.
+    """
+    queue = Queue(maxsize=size)
+    done = object()
+    failure = []
+    stopped = Event()
+
+    def fetch():
+        """ Put items into the queue until they are exhausted. """
         try:
-            probe = loads(decompress(cprobe))
-        # Backward compatibility when bandwidth probes were not implemented.
-        except TypeError:
-            from NavigaTor import Probe_old as Probe
-            probe = loads(decompress(cprobe))
+            for item in items:
+                queue.put(decode(item) if decode else item)
+                if stopped.is_set():
+                    return
+        except Exception:
+            failure.append(exc_info())
+        queue.put(done)
+
+    thread = Thread(target=fetch)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            item = queue.get()
+            if item is done:
+                break
+            yield item
+    finally:
+        # Unblock the thread waiting for room in the queue.
+        stopped.set()
+        while thread.is_alive():
+            try:
+                queue.get(timeout=0.1)
+            except Empty:
+                pass
+    if failure:
+        raise failure[0][0], failure[0][1], failure[0][2]
+
+
+def _archive(path, prefix, decode=None):
+    """
+    Iterate through members of an archive file with read-ahead, and report
+    progress every PROGRESS members and throughput on stderr.
+    """
+    start = time()
+    num = 0
+    with open(path, 'rb') as fileobj:
+        for member in _read_ahead(_members(fileobj, prefix), READAHEAD,
+                                  decode):
+            num += 1
+            if num % PROGRESS == 0:
+                duration = max(time() - start, 1e-6)
+                stderr.write('%s: %d members so far (%.0f members/s).\n'
+                             % (path, num, num / duration))
+            yield member
+    duration = max(time() - start, 1e-6)
+    size = getsize(path) / 1e6
+    stderr.write('%s: %d members, %.1f MB in %.1f s (%.0f members/s, '
+                 '%.1f MB/s).\n'
+                 % (path, num, size, duration, num / duration,
+                    size / duration))
+
+
+def cprobes(paths=None, prefix='Probe_', decode=None):
+    """
+    Iterate through compressed probes generated by NavigaTor, or other
+    members whose names start with prefix.
+        "paths": archive files read one after another, stdin if None.
+        "decode": function applied to members by the read-ahead thread.
+    """
+    if not paths:
+        for member in _read_ahead(_members(stdin, prefix), READAHEAD,
+                                  decode):
+            yield member
+        return
+    for path in paths:
+        for member in _archive(path, prefix, decode):
+            yield member
+
+
+def _decode(cprobe, unpickle=loads):
+    """ Uncompress and unpickle a probe. """
+    try:
+        return unpickle(decompress(cprobe))
+    # Backward compatibility when bandwidth probes were not implemented.
+    except TypeError:
+        from NavigaTor import Probe_old as Probe
+        return unpickle(decompress(cprobe))
+
+
+def _decode_stubbed(cprobe):
+    """ Uncompress and unpickle a probe with stubs of stem events. """
+    return _decode(cprobe, loads_stubbed)
+
+
+def probes(paths=None, stubs=False):
+    """
+    Iterate through uncompressed probes generated by NavigaTor. Probes of
+    archives given by paths are decoded by their read-ahead thread.
+        "stubs": replace stem events by stubs.
+    """
+    for probe in cprobes(paths,
+                         decode=_decode_stubbed if stubs else _decode):
         yield probe
 
 
+def calibrations(paths=None):
+    """ Iterate through calibrations of local overhead by NavigaTor. """
+    for ccalibration in cprobes(paths, prefix='Calibration_'):
+        yield loads(decompress(ccalibration))
+
+
 def _checkcircs(path, circs):
     """ Check validity of circuits. """
     assert len(set([circ.id for circ in circs])) == 1, \
@@ -210,120 +535,329 @@ def _checkcircs(path, circs):
             'Last status: %s.' % stati[len(stati) - 1]
 
 
-def _main():
-    """ Actually run tests and calculate RTTs. """
-    nr_measurements = None
-    global_addresses = set()
-
-    for probe in probes():
-        assert isinstance(probe, Probe), \
-            'Probe has wrong type: %s' % type(probe)
-        _checkpath(probe.path)
-
-        # calculate number of measurements
-        streams = dict()
-        address = set()
-        for stream in probe.streams:
-            if stream.id not in streams:
-                streams[stream.id] = []
-            streams[stream.id].append(stream)
-            address.add(stream.target_address)
-        if not nr_measurements:
-            nr_measurements = len(streams)
-        assert len(streams) == 0 or len(streams) == nr_measurements, \
-            'Wrong number of measurements.'
-
-        # Check occurences of target addresses
-        assert len(address) in range(0, 2), \
-            'Target address occured %d.' % len(address)
-        if len(address) == 1:
-            address = address.pop()
-            assert address not in global_addresses, \
-                'Target address has been used before.'
-            global_addresses.add(address)
-
-        # classify measurements
-        good_streams = []
-        bad_streams = []
-        timeout_streams = []
-        for sid in streams.iterkeys():
-            stream = streams[sid]
-            if stream_from_good_probe(stream):
-                good_streams.append(stream)
-            elif stream_from_bad_probe(stream):
-                bad_streams.append(stream)
-            elif stream_from_timeout_probe(stream):
-                timeout_streams.append(stream)
+def _check_probe(probe, nr_measurements):
+    """
+    Check validity of a probe. Return its classification, the
+    classifications of its streams, its target address and the number of
+    measurements expected of probes without adaptive RTT sampling. Probes
+    with another number of measurements are classified as 'Mismatched'.
+        "nr_measurements": number of measurements of the previous probes
+                           without adaptive RTT sampling, None if unknown.
+    """
+    assert isinstance(probe, Probe), \
+        'Probe has wrong type: %s' % type(probe)
+    _checkpath(probe.path)
+
+    # Probes of reclaimed workers are incomplete.
+    if probe.reason:
+        assert probe.reason.startswith(('TIMEOUT_', 'FAILED_')), \
+            'Wrong reason: %s.' % probe.reason
+        return 'Reclaimed', [], None, nr_measurements
+
+    # calculate number of measurements
+    streams = dict()
+    address = set()
+    for stream in probe.streams:
+        if stream.id not in streams:
+            streams[stream.id] = []
+        streams[stream.id].append(stream)
+        address.add(stream.target_address)
+    # Adaptive RTT sampling takes a varying number of measurements.
+    measurements = nr_measurements
+    if probe.rttstop:
+        assert probe.rttstop.reason in ('HALFWIDTH', 'MAXIMUM'), \
+            'Wrong RTT stop reason: %s.' % probe.rttstop.reason
+        measurements = probe.rttstop.samples
+    elif not nr_measurements:
+        nr_measurements = measurements = len(streams)
+    if len(streams) != 0 and len(streams) != measurements:
+        return 'Mismatched', [], None, nr_measurements
+
+    # Check occurences of target addresses
+    assert len(address) in range(0, 2), \
+        'Target address occured %d.' % len(address)
+    address = address.pop() if address else None
+
+    # classify measurements
+    classes = [classify_stream(stream) for stream in streams.itervalues()]
+    good_streams = [stream for stream, cls in zip(streams.itervalues(),
+                                                  classes) if cls == 'GOOD']
+    timeout_streams = [cls for cls in classes if cls == 'TIMEOUT']
+    assert None not in classes, 'Stream classification is broken.'
+
+    # Calculate RTTS for probe
+    rtts = [srm[2].arrived_at - srm[0].arrived_at for srm in good_streams]
+    _checkcircs(probe.path, probe.circs)
+
+    # Circuit classification
+    built = _built_circuit(probe.circs)
+    finished = _finished_circuit(probe.circs)
+    assert len(rtts) == 0 or built, \
+        'Circuit did not build but has measurements.'
+    assert _valid_circuit(probe.circs), 'Circuit detection is broken.'
+    assert built or not finished, 'Circuit detection is really broken.'
+    assert (len(rtts) + len(timeout_streams)) == measurements or \
+        not finished, 'Circuit finished but not enough measurements.'
+
+    # Check measurements and path length
+    assert _good_path(probe.path) or len(rtts) == 0, \
+        'RTTs measured but path is not good!'
+    for rtt in rtts:
+        assert isinstance(rtt, float), 'Wrong RTT type: %s' % type(rtt)
+
+    # Check CBT
+    assert isinstance(probe.cbt, set), \
+        'CBT has wrong type: %s.' % type(probe.cbt)
+    assert len(probe.cbt) in range(0, 2), \
+        'CBT has wrong size: %d.' % len(probe.cbt)
+    assert len(probe.cbt) == 1 or len(rtts) == 0, \
+        'Probe has no CBT but RTTs.'
+
+    # Check performance measurements
+    assert isinstance(probe.perf, list), \
+        'Performance measurement has wrong type: %s' % type(probe.perf)
+    assert len(probe.cbt) == 1 or len(probe.perf) == 0, \
+        'Probe has no CBT but performance measurements.'
+    for perf in probe.perf:
+        assert len(perf) == 1 or len(perf) == 3, \
+            'Performance measurement has wrong length: %d' % len(perf)
+        if len(perf) == 1:
+            assert isinstance(perf[0], str), \
+                'Wrong perf type: %s' % type(perf[0])
+        elif len(perf) == 3:
+            for i in perf:
+                assert isinstance(i, float), \
+                    'Wrong measurement type: %s' % type(i)
+    assert len(probe.cbt) == 1 or len(probe.bw) == 0, \
+        'Probe has no CBT but bandwidth measurements.'
+    for bwp in probe.bw:
+        assert len(bwp) == 1 or len(bwp) == 3, \
+            'Bandwidth measurement has wrong length: %d' % len(bwp)
+        if len(bwp) == 1:
+            assert isinstance(bwp[0], str), \
+                'Wrong bw type: %s' % type(bwp[0])
+        elif len(bwp) == 3:
+            for i in bwp:
+                assert isinstance(i, float), \
+                    'Wrong measurement type: %s' % type(i)
+
+    # Check throughput time-series of bandwidth measurements
+    if probe.bwsamples is not None:
+        assert len(probe.bwsamples) == len(probe.bw), \
+            'Wrong number of bandwidth time-series: %d' % \
+            len(probe.bwsamples)
+        for times, received in probe.bwsamples:
+            assert len(times) == len(received), \
+                'Bandwidth time-series have different lengths.'
+
+    text = 'Broken'
+    if built:
+        text = 'Built'
+    if finished:
+        text = 'Finished'
+    return text, classes, address, nr_measurements
+
+
+def _failure(error):
+    """
+    Reason of a failed check, with numbers and fingerprints left out so that
+    failures of different probes are counted together.
+    """
+    if isinstance(error, AssertionError):
+        reason = str(error)
+    else:
+        reason = '%s: %s' % (type(error).__name__, error)
+    return sub(r'[0-9A-Fa-f]{40}|\d+', '#', reason)
+
+
+class _Report(object):
+    """ Counts of classifications and failures of probes per archive. """
+    def __init__(self):
+        self.circuits = Counter()
+        self.streams = Counter()
+        self.failures = Counter()
+        self.archives = OrderedDict()
+        self.addresses = dict()
+        self.measurements = dict()
+
+    def add(self, archive, classification, classes, address):
+        """ Add a valid probe of archive. """
+        self.circuits[classification] += 1
+        if classification == 'Mismatched':
+            self.archives.setdefault(archive, Counter())['mismatched'] += 1
+        self.streams.update(classes)
+        if address is None:
+            return
+        if address in self.addresses:
+            self.fail(archive, 'Target address has been used before.')
+        else:
+            self.addresses[address] = archive
+
+    def count(self, archive):
+        """ Count a probe of archive. """
+        self.archives.setdefault(archive, Counter())['probes'] += 1
+
+    def fail(self, archive, reason):
+        """ Add a failed check of archive. """
+        self.archives.setdefault(archive, Counter())['failed'] += 1
+        self.failures[reason] += 1
+
+    def merge(self, other):
+        """ Add report of other archives. """
+        self.circuits.update(other.circuits)
+        self.streams.update(other.streams)
+        self.failures.update(other.failures)
+        for archive, stats in other.archives.iteritems():
+            self.archives.setdefault(archive, Counter()).update(stats)
+        for address, archive in other.addresses.iteritems():
+            if address in self.addresses:
+                self.fail(archive, 'Target address has been used before.')
             else:
-                # debug stream classification
-                for i in stream:
-                    stdout.write(str(i) + '\n')
-        total_len = len(good_streams) + len(bad_streams) + len(timeout_streams)
-        assert len(streams) == total_len, 'Stream classification is broken.'
-
-        # Calculate RTTS for probe
-        rtts = [srm[2].arrived_at - srm[0].arrived_at for srm in good_streams]
-        _checkcircs(probe.path, probe.circs)
-
-        # Circuit classification
-        built = _built_circuit(probe.circs)
-        finished = _finished_circuit(probe.circs)
-        assert len(rtts) == 0 or built, \
-            'Circuit did not build but has measurements.'
-        assert _valid_circuit(probe.circs), 'Circuit detection is broken.'
-        assert built or not finished, 'Circuit detection is really broken.'
-        assert (len(rtts) + len(timeout_streams)) == nr_measurements or \
-            not finished, 'Circuit finished but not enough measurements.'
-
-        # Check measurements and path length
-        assert _good_path(probe.path) or len(rtts) == 0, \
-            'RTTs measured but path is not good!'
-        for rtt in rtts:
-            assert isinstance(rtt, float), 'Wrong RTT type: %s' % type(rtt)
-
-        # Check CBT
-        assert isinstance(probe.cbt, set), \
-            'CBT has wrong type: %s.' % type(probe.cbt)
-        assert len(probe.cbt) in range(0, 2), \
-            'CBT has wrong size: %d.' % len(probe.cbt)
-        assert len(probe.cbt) == 1 or len(rtts) == 0, \
-            'Probe has no CBT but RTTs.'
-
-        # Check performance measurements
-        assert isinstance(probe.perf, list), \
-            'Performance measurement has wrong type: %s' % type(probe.perf)
-        assert len(probe.cbt) == 1 or len(probe.perf) == 0, \
-            'Probe has no CBT but performance measurements.'
-        for perf in probe.perf:
-            assert len(perf) == 1 or len(perf) == 3, \
-                'Performance measurement has wrong length: %d' % len(perf)
-            if len(perf) == 1:
-                assert isinstance(perf[0], str), \
-                    'Wrong perf type: %s' % type(perf[0])
-            elif len(perf) == 3:
-                for i in perf:
-                    assert isinstance(i, float), \
-                        'Wrong measurement type: %s' % type(i)
-        assert len(probe.cbt) == 1 or len(probe.bw) == 0, \
-            'Probe has no CBT but bandwidth measurements.'
-        for bwp in probe.bw:
-            assert len(bwp) == 1 or len(bwp) == 3, \
-                'Bandwidth measurement has wrong length: %d' % len(bwp)
-            if len(bwp) == 1:
-                assert isinstance(bwp[0], str), \
-                    'Wrong bw type: %s' % type(bwp[0])
-            elif len(bwp) == 3:
-                for i in bwp:
-                    assert isinstance(i, float), \
-                        'Wrong measurement type: %s' % type(i)
-
-        text = 'Broken'
-        if built:
-            text = 'Built'
-        if finished:
-            text = 'Finished'
-        stdout.write('%s circuit has %d good and %d timedout measurements.\n'
-                     % (text, len(rtts), len(timeout_streams)))
+                self.addresses[address] = archive
+        self.measurements.update(other.measurements)
+
+    def _measurements_differ(self):
+        """ Check if archives differ in their number of measurements. """
+        return len(set(self.measurements.itervalues()) - set([None])) > 1
+
+    def failed(self):
+        """
+        Check if any probe failed or has another number of measurements
+        than the others.
+        """
+        return bool(self.failures) or self.circuits['Mismatched'] > 0 or \
+            self._measurements_differ()
+
+    def write(self, output):
+        """ Write report. """
+        output.write('Circuits:\n')
+        for text, num in sorted(self.circuits.iteritems()):
+            output.write('  %s: %d\n' % (text, num))
+        output.write('Streams:\n')
+        for cls, num in sorted(self.streams.iteritems()):
+            output.write('  %s: %d\n' % (cls, num))
+        output.write('Failures:\n')
+        for reason, num in self.failures.most_common():
+            output.write('  %s: %d\n' % (reason, num))
+        if self._measurements_differ():
+            output.write('  Archives differ in number of measurements: '
+                         '%s\n' % self.measurements)
+        output.write('Archives:\n')
+        for archive, stats in self.archives.iteritems():
+            output.write('  %s: %d probes, %d failed, %d mismatched\n'
+                         % (archive, stats['probes'], stats['failed'],
+                            stats['mismatched']))
+
+
+def _expected(cprobe, stubs, nr_measurements):
+    """
+    Return the number of measurements expected of probes without adaptive
+    RTT sampling once cprobe has been checked, see _check_probe().
+    """
+    try:
+        probe = _decode(cprobe, loads_stubbed if stubs else loads)
+        return _check_probe(probe, nr_measurements)[3]
+    except Exception:
+        return nr_measurements
+
+
+def _batches(paths, stubs, slots, size=BATCH):
+    """
+    Group the compressed probes of each archive into batches, of stdin if
+    there are no paths, and generate the tasks of _validate(). Each batch
+    is checked starting from the number of measurements expected after the
+    probes before it. Until that number is known, probes are checked here
+    as well, and a batch ends as soon as it is. Each batch takes one of
+    the slots, which bounds how far ahead of the checks input is read.
+    """
+    for path in paths or [None]:
+        archive = path or '-'
+        nr_measurements = start = None
+        batch = []
+        broken = None
+        try:
+            for cprobe in cprobes([path] if path else None):
+                batch.append(cprobe)
+                known = bool(nr_measurements)
+                if not known:
+                    nr_measurements = _expected(cprobe, stubs,
+                                                nr_measurements)
+                if len(batch) == size or known != bool(nr_measurements):
+                    slots.acquire()
+                    yield archive, batch, stubs, start, None
+                    batch = []
+                    start = nr_measurements
+        except Exception, error:
+            broken = 'Archive is broken: %s' % _failure(error)
+        slots.acquire()
+        yield archive, batch, stubs, start, broken
+
+
+def _validate(task):
+    """
+    Check validity of a batch of compressed probes of an archive. Return a
+    report. A task consists of:
+        "archive": path of the archive, '-' for stdin.
+        "batch": compressed probes.
+        "stubs": replace stem events by stubs.
+        "nr_measurements": number of measurements expected at the start of
+                           the batch, see _check_probe().
+        "broken": why the archive is broken after the batch, None if not.
+    """
+    archive, batch, stubs, nr_measurements, broken = task
+    report = _Report()
+    for cprobe in batch:
+        report.count(archive)
+        try:
+            probe = _decode(cprobe, loads_stubbed if stubs else loads)
+            classification, classes, address, nr_measurements = \
+                _check_probe(probe, nr_measurements)
+        except Exception, error:
+            report.fail(archive, _failure(error))
+            continue
+        report.add(archive, classification, classes, address)
+    if broken:
+        report.fail(archive, broken)
+    report.measurements[archive] = nr_measurements
+    return report
+
+
+def _main():
+    """
+    Check validity of probes and report counts of classifications and
+    failures. Batches of probes are checked in parallel, and their target
+    addresses must be unique across all archives.
+    """
+    parser = ArgumentParser(description="Verify NavigaTor's output.")
+    parser.add_argument("archives", nargs='*',
+                        help="Archive files or glob patterns (default: "
+                        "stdin).")
+    parser.add_argument("--stubs", action='store_true',
+                        help="Unpickle stem events into lightweight "
+                        "stubs.")
+    args = parser.parse_args()
+    paths = archives(args.archives)
+
+    report = _Report()
+    try:
+        cpus = cpu_count()
+    except NotImplementedError:
+        cpus = 1
+    slots = Semaphore(2 * cpus)
+    pool = Pool(cpus)
+    try:
+        for other in pool.imap(_validate,
+                               _batches(paths, args.stubs, slots)):
+            report.merge(other)
+            slots.release()
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        raise
+    pool.join()
+    report.write(stdout)
+    if report.failed():
+        exit(1)
 
 
 if __name__ == '__main__':
@@ -7,35 +7,50 @@
 # License: GPLv2 (2013-2015)
 
 import sys
-from cPickle import loads, dump, HIGHEST_PROTOCOL
-from Queue import Queue
-from multiprocessing import Manager
-from multiprocessing import cpu_count
+from cPickle import loads, dumps, HIGHEST_PROTOCOL
+from tempfile import mkdtemp
+from shutil import copyfileobj, rmtree
+from os import remove
+from functools import partial
+from multiprocessing import cpu_count, Value, TimeoutError
 from multiprocessing.pool import Pool
-from os.path import dirname, abspath
+from threading import Semaphore
+from argparse import ArgumentParser
+from time import time
+from traceback import format_exc
+from os.path import dirname, abspath, join
 
 from lzo import decompress
 from collections import namedtuple
 
 sys.path.append(dirname(abspath(__file__)))
 from testdata import stream_from_good_probe, stream_from_timeout_probe
-from testdata import stream_from_bad_probe, cprobes
+from testdata import stream_from_bad_probe, cprobes, archives
+from testdata import loads_stubbed, WORKER, init_worker
 from NavigaTor import Node, Probe
 
 
+# Seconds between reports of the number of truncated probes.
+PROGRESS_INTERVAL = 10
+
 # Probedata = namedtuple('Probedata', 'date entry exit cbt rtts perfs bws')
 Probedata = namedtuple('Probedata', 'date entry middle exit cbt rtts perfs bws')
 
 
-def _truncate(cprobe, wlock):
+def _truncate(cprobe, unpickle=loads_stubbed, decompressed=False):
     """
-    Truncate data from measurement and write serialized output to stdout.
+    Truncate data from measurement. Return None for probes without circuit.
+        "unpickle": function that unpickles the uncompressed probe.
+        "decompressed": whether the probe has already been uncompressed.
     """
     def to_ms(val):
         """ Convert value to ms. """
         return int(round((val * 1000)))
 
-    probe = loads(decompress(cprobe))
+    probe = unpickle(cprobe if decompressed else decompress(cprobe))
+    # Skip probes of workers that were reclaimed before launching a circuit.
+    if not probe.circs:
+        return None
 
     cbt = None
     if len(probe.cbt) > 0:
@@ -80,43 +95,203 @@ def _truncate(cprobe, wlock):
     # Backward compatibility when bandwidth probes were not implemented.
     except AttributeError:
         bws.append(None)
-    probedata = Probedata(date=probe.circs[0].created,
-                          entry=probe.path[0].desc.fingerprint,
-                          middle=probe.path[1].desc.fingerprint,
-                          exit=probe.path[2].desc.fingerprint,
-                          cbt=cbt, rtts=rtts, perfs=perfs, bws=bws)
-    with wlock:
-        dump(probedata, sys.stdout, HIGHEST_PROTOCOL)
-        sys.stdout.flush()
-
-
-class PoolLimit(Pool):
-    """ Limit maximum number of tasks in the waiting queue to 2*cpu_count. """
-    def __init__(self):
+    return Probedata(date=probe.circs[0].created,
+                     entry=probe.path[0].desc.fingerprint,
+                     middle=probe.path[1].desc.fingerprint,
+                     exit=probe.path[2].desc.fingerprint,
+                     cbt=cbt, rtts=rtts, perfs=perfs, bws=bws)
+
+
+def _truncate_safe(cprobe, unpickle, decompressed=False):
+    """
+    Truncate data from measurement and serialize it. Return an empty string
+    for probes without circuit, and for None instead of a probe that could
+    not be uncompressed. Broken measurements are reported and skipped.
+    """
+    if cprobe is None:
+        return ''
+    try:
+        probedata = _truncate(cprobe, unpickle, decompressed)
+    except Exception:
+        sys.stderr.write(format_exc())
+        return ''
+    if not probedata:
+        return ''
+    return dumps(probedata, HIGHEST_PROTOCOL)
+
+
+def _count(num):
+    """ Add num to the shared counter of truncated measurements. """
+    truncated = WORKER['truncated']
+    with truncated.get_lock():
+        truncated.value += num
+
+
+def _truncate_batch(batch, unpickle):
+    """ Truncate a batch of measurements. Return the serialized results. """
+    data = ''.join(_truncate_safe(cprobe, unpickle) for cprobe in batch)
+    _count(len(batch))
+    return data
+
+
+def _decompress_safe(cprobe):
+    """
+    Uncompress a probe in the read-ahead thread. Return None for broken
+    probes, which are reported.
+    """
+    try:
+        return decompress(cprobe)
+    except Exception:
+        sys.stderr.write(format_exc())
+        return None
+
+
+def _truncate_archive(task, unpickle):
+    """
+    Truncate all measurements of an archive file into a temporary file,
+    which is removed again if truncating fails. Probes are uncompressed by
+    the read-ahead thread. Return the name of the file.
+        "task": path of the archive and name of the temporary file.
+    """
+    path, name = task
+    try:
+        with open(name, 'wb') as output:
+            for data in cprobes([path], decode=_decompress_safe):
+                output.write(_truncate_safe(data, unpickle, True))
+                _count(1)
+    except Exception:
+        remove(name)
+        raise
+    return name
+
+
+def _progress(results, truncated, start):
+    """
+    Iterate through the results of a pool, and report the number of
+    truncated measurements every PROGRESS_INTERVAL seconds meanwhile.
+    """
+    while True:
         try:
-            cpus = cpu_count()
-        except NotImplementedError:
-            cpus = 1
-        self._taskqueue = Queue(maxsize=(2 * cpus))
-        Pool.__init__(self)
+            yield results.next(PROGRESS_INTERVAL)
+        except TimeoutError:
+            duration = max(time() - start, 1e-6)
+            sys.stderr.write('Truncated %d probes so far (%.0f probes/s).\n'
+                             % (truncated.value, truncated.value / duration))
+        except StopIteration:
+            return
+
+
+def _batches(items, size, slots):
+    """
+    Group items into lists of the given size. Each list takes one of the
+    slots, which bounds how far ahead of the output input is read.
+    """
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            slots.acquire()
+            yield batch
+            batch = []
+    if batch:
+        slots.acquire()
+        yield batch
+
+
+def _compare(items):
+    """
+    Truncate each measurement with stubs of stem events and fully
+    unpickled, check that the results are identical and report timings.
+    """
+    durations = {loads: 0.0, loads_stubbed: 0.0}
+    num = 0
+    for cprobe in items:
+        results = dict()
+        for unpickle in durations:
+            start = time()
+            results[unpickle] = _truncate(cprobe, unpickle)
+            durations[unpickle] += time() - start
+        assert results[loads] == results[loads_stubbed], \
+            'Results differ: %s != %s.' % (results[loads],
+                                           results[loads_stubbed])
+        num += 1
+    for unpickle, name in ((loads, 'Full'), (loads_stubbed, 'Stubbed')):
+        duration = max(durations[unpickle], 1e-6)
+        sys.stderr.write('%s: %d probes in %.1f s (%.0f probes/s).\n'
+                         % (name, num, duration, num / duration))
+    sys.stderr.write('All %d results are identical.\n' % num)
 
 
 def _main():
-    """ Start multiple processes to truncate data out of measurements. """
-    wlock = Manager().Lock()
-    pool = PoolLimit()
-    probes = cprobes()
+    """
+    Start multiple processes to truncate data out of measurements. Archive
+    files are spread across the processes, or batches of probes if read
+    from stdin. Results are written to stdout in input order.
+    """
+    parser = ArgumentParser(description="Truncate data from NavigaTor " +
+                                        "measurements.")
+    parser.add_argument("--batch", type=int, default=256,
+                        help="Number of probes sent to a process at once "
+                        "when reading from stdin.")
+    parser.add_argument("archives", nargs='*',
+                        help="Archive files or glob patterns (default: "
+                        "stdin).")
+    parser.add_argument("--full", action='store_true',
+                        help="Fully unpickle probes instead of using stubs "
+                        "of stem events.")
+    parser.add_argument("--compare", action='store_true',
+                        help="Only check that stubs and full unpickling "
+                        "give identical results, and compare their speed.")
+    args = parser.parse_args()
+    paths = archives(args.archives)
+    if args.compare:
+        _compare(cprobes(paths))
+        return
+    unpickle = loads if args.full else loads_stubbed
+    assert args.batch > 0, 'Invalid batch size.'
+
     try:
-        while True:
-            try:
-                cprobe = probes.next()
-            except StopIteration:
-                break
-            pool.apply_async(_truncate, (cprobe, wlock))
+        cpus = cpu_count()
+    except NotImplementedError:
+        cpus = 1
+    slots = Semaphore(2 * cpus)
+    truncated = Value('l', 0)
+    pool = Pool(cpus, init_worker, (dict(truncated=truncated),))
+    # Temporary files of archives, removed even if truncating is aborted.
+    temp = mkdtemp(prefix='truncatedata_')
+    start = time()
+    try:
+        if paths:
+            tasks = [(path, join(temp, '%06d' % i))
+                     for i, path in enumerate(paths)]
+            for name in _progress(pool.imap(partial(_truncate_archive,
+                                                    unpickle=unpickle),
+                                            tasks), truncated, start):
+                try:
+                    with open(name, 'rb') as data:
+                        copyfileobj(data, sys.stdout)
+                finally:
+                    remove(name)
+        else:
+            for data in _progress(pool.imap(partial(_truncate_batch,
+                                                    unpickle=unpickle),
+                                            _batches(cprobes(), args.batch,
+                                                     slots)),
+                                  truncated, start):
+                sys.stdout.write(data)
+                slots.release()
         pool.close()
         pool.join()
     except KeyboardInterrupt:
-        pass
+        pool.terminate()
+        pool.join()
+    finally:
+        rmtree(temp, ignore_errors=True)
+    sys.stdout.flush()
+    duration = max(time() - start, 1e-6)
+    sys.stderr.write('Truncated %d probes in %.1f s (%.0f probes/s).\n'
+                     % (truncated.value, duration,
+                        truncated.value / duration))
 
 
 if __name__ == '__main__':